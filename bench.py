@@ -0,0 +1,468 @@
+"""
+Benchmarks for convert.py against a generated vault.
+
+    python bench.py --notes 2000 --links 20
+    python bench.py load links --notes 200 --links 400 --per-line 8
+    python bench.py build --notes 20000 --resources 500 --jobs 4 --json after.json --compare before.json
+
+Each benchmark runs in its own process, so its peak RSS and caches are its own.
+Needs neither zola nor obsidian-export.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional
+
+TAGS = ["book", "article", "fieldnote", "philosophy", "misc", "todo"]
+
+# lines rendering each distinct link once has to rewrite exactly like rendering every link
+LINK_EDGE_CASES = [
+    "See [A](a.md#x) first, then again ([A](a.md#x)) here.\n",
+    "[A](a.md) and [A](http://a.md) and [A](a.md)\\\\\n",
+    "![A](a.png) [A](a.png) [[A](a.md)](b.md)\n",
+]
+
+# results of the benchmark running in this process
+RESULTS: List[dict] = []
+
+# ---------------------------------------------------------------------------- #
+#                                Vault Generator                               #
+# ---------------------------------------------------------------------------- #
+
+def generate_folders(depth: int, fanout: int) -> List[str]:
+    """vault root plus a tree of nested folders, fanout children per folder"""
+    folders = [""]
+    level = [""]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, f"Folder {parent.count('/') + 1}-{i}")
+            for parent in level
+            for i in range(fanout)
+        ]
+        folders.extend(level)
+    return folders
+
+
+def pick_tags(rng: random.Random, skew: float) -> List[str]:
+    """one or two tags, zipf-like: the first tags are the most common"""
+    weights = [1 / (rank + 1) ** skew for rank in range(len(TAGS))]
+    return sorted(set(rng.choices(TAGS, weights, k=rng.randint(1, 2))), key=TAGS.index)
+
+
+def generate_vault(
+    root: Path,
+    notes: int,
+    links: int,
+    seed: int = 0,
+    per_line: int = 1,
+    fields: int = 1,
+    tag_skew: float = 0.0,
+    resources: int = 0,
+    depth: int = 1,
+    fanout: int = 4,
+) -> List[Path]:
+    """writes a vault shaped like obsidian-export output, returns note paths.
+    fields adds extra frontmatter keys, every resource is embedded by some note"""
+    rng = random.Random(seed)
+    folders = generate_folders(depth, fanout)
+    names = [(folders[i % len(folders)], f"Note {i}") for i in range(notes)]
+    images = [(folders[i % len(folders)], f"image {i}.png") for i in range(resources)]
+    paths = []
+
+    def relative(folder: str, other_folder: str, name: str) -> str:
+        rel = os.path.relpath(os.path.join(other_folder, name), folder or ".")
+        return rel.replace(" ", "%20")
+
+    for folder, name in images:
+        directory = root / folder
+        directory.mkdir(parents=True, exist_ok=True)
+        (directory / name).write_bytes(rng.getrandbits(2048 * 8).to_bytes(2048, "little"))
+
+    for i, (folder, name) in enumerate(names):
+        directory = root / folder
+        directory.mkdir(parents=True, exist_ok=True)
+        frontmatter = [
+            "---",
+            f"tags: [{', '.join(pick_tags(rng, tag_skew))}]",
+            f"created: 2023-01-{1 + i % 28:02d} 10:00",
+            f"modified: 2024-01-{1 + i % 28:02d}T10:00:00",
+            *(f"field{k}: value {k} of {name}" for k in range(fields)),
+            "---",
+        ]
+        body = []
+        for line in range(max(-(-links // per_line), 10)):
+            text = f"Line {line} of {name}, lorem ipsum dolor sit amet."
+            for _ in range(min(per_line, links - line * per_line)):
+                other_folder, other = names[rng.randrange(notes)]
+                text += f" See [{other}]({relative(folder, other_folder, other + '.md')})."
+            body.append(text)
+        for other_folder, image in images[i::notes]:
+            body.append(f"![{image}]({relative(folder, other_folder, image)})")
+
+        path = directory / f"{name}.md"
+        path.write_text("\n".join(frontmatter + body) + "\n")
+        paths.append(path)
+
+    return paths
+
+
+def prepare_site(site: Path):
+    """the theme files convert.py fills in, and the environment it requires"""
+    for rel_path, text in (
+        ("config.toml", 'base_url = "___SITE_URL___"\ntitle = "___SITE_TITLE___"\n'),
+        ("content/_index.md", '+++\ntitle = "___LANDING_TITLE___"\n+++\n'),
+        ("static/js/graph.js", "var options = ___GRAPH_OPTIONS___;\n"),
+    ):
+        (site / rel_path).parent.mkdir(parents=True, exist_ok=True)
+        (site / rel_path).write_text(text)
+    for key, value in (("SITE_URL", "https://example.com"), ("REPO_URL", "https://example.com/repo"), ("LANDING_PAGE", "Note-0")):
+        os.environ.setdefault(key, value)
+
+# ---------------------------------------------------------------------------- #
+#                                  Benchmarks                                  #
+# ---------------------------------------------------------------------------- #
+
+def legacy_load(path: Path):
+    """access pattern of process_page before Document: 4 reads, 3 yaml parses"""
+    import yaml
+
+    def read_content():
+        with open(path, "r") as f:
+            lines = f.readlines()
+            if lines[0].startswith("---"):
+                for i, line in enumerate(lines[1:]):
+                    if line.startswith("---"):
+                        return lines[i + 2:]
+            return lines
+
+    def read_frontmatter():
+        with open(path, "r") as f:
+            lines = f.readlines()
+            if lines[0].startswith("---"):
+                for i, line in enumerate(lines[1:]):
+                    if line.startswith("---"):
+                        return yaml.load("".join(lines[1:i + 1]), Loader=yaml.FullLoader)
+            return {}
+
+    def read_modified():
+        fm = read_frontmatter()
+        if "modified" in fm:
+            return str(fm["modified"])
+        return datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
+
+    read_content()
+    read_frontmatter()
+    read_modified()
+    read_modified()
+
+
+def document_load(path: Path):
+    """access pattern of process_page through DocPath"""
+    from utils import DocPath
+
+    doc_path = DocPath(path)
+    doc_path.content
+    doc_path.frontmatter
+    doc_path.modified
+
+
+def peak_rss_mb() -> float:
+    """peak resident set size of this process and its finished children"""
+    peak = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    return peak / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def record(label: str, elapsed: float, count: int, unit: str = "pages") -> float:
+    """prints and keeps one measurement"""
+    RESULTS.append({
+        "label": label,
+        "seconds": round(elapsed, 6),
+        "rate": round(count / elapsed, 1),
+        "unit": unit,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    })
+    print(f"{label:<24} {elapsed:8.3f}s  {count / elapsed:10.1f} {unit}/s  {RESULTS[-1]['peak_rss_mb']:8.1f} MB")
+    return elapsed
+
+
+def timed(
+    label: str, func: Callable, items: list, repeat: int = 1, setup: Optional[Callable] = None, unit: str = "pages"
+) -> float:
+    """best of repeat runs of func over items, setup runs untimed before each"""
+    elapsed = float("inf")
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return record(label, elapsed, len(items), unit)
+
+
+def bench_load(paths: List[Path], args: argparse.Namespace):
+    """reading content, frontmatter and modification date of every page"""
+    before = timed("before", legacy_load, paths)
+    after = timed("after", document_load, paths)
+    print(f"speedup                  {before / after:8.2f}x")
+
+
+def bench_frontmatter(paths: List[Path], args: argparse.Namespace):
+    """parsing every page's frontmatter: FullLoader, CSafeLoader, CSafeLoader cached by text"""
+    import yaml
+    from utils import Document, load_yaml, parse_frontmatter
+
+    raws = [Document(path).raw_frontmatter for path in paths]
+    before = timed("full loader", lambda raw: yaml.load(raw, Loader=yaml.FullLoader), raws)
+    timed("safe loader", load_yaml, raws)
+    after = timed("safe loader, cached", parse_frontmatter, raws, setup=parse_frontmatter.cache_clear)
+    print(f"speedup                  {before / after:8.2f}x ({len(set(raws))} distinct)")
+
+
+def bench_links(paths: List[Path], args: argparse.Namespace):
+    """rewriting every link of every page body"""
+    from utils import LINE_BREAK_PATTERN, DocLink, DocPath
+
+    doc_paths = [DocPath(path) for path in paths]
+    for doc_path in doc_paths:
+        doc_path.content
+
+    def render_every_link(lines: List[str], doc_path: DocPath):
+        """parse_lines without its per page memo"""
+        parsed = [DocLink.parse(line, doc_path) for line in lines]
+        return (
+            "".join(LINE_BREAK_PATTERN.sub(r"\\\\\\\\", line) for line, _ in parsed),
+            [url for _, linked in parsed for url in linked],
+        )
+
+    for doc_path, lines in [(doc_path, doc_path.content) for doc_path in doc_paths] + [
+        (doc_paths[0], [line]) for line in LINK_EDGE_CASES
+    ]:
+        if DocLink.parse_lines(lines, doc_path) != render_every_link(lines, doc_path):
+            sys.exit(f"memoized parse differs: {doc_path.old_rel_path} {lines[:1]}")
+
+    def compare(suffix: str):
+        before = timed("every link" + suffix, lambda doc_path: render_every_link(doc_path.content, doc_path), doc_paths, 3, clear_caches)
+        after = timed("memoized" + suffix, lambda doc_path: DocLink.parse_lines(doc_path.content, doc_path), doc_paths, 3, clear_caches)
+        print(f"speedup                  {before / after:8.2f}x")
+
+    compare("")
+
+    abs_url = DocLink.abs_url
+    DocLink.abs_url = lambda link, doc_path: "/" + link.url
+    try:
+        compare(", no urls")
+    finally:
+        DocLink.abs_url = abs_url
+
+
+def bench_urls(paths: List[Path], args: argparse.Namespace):
+    """resolving and slugifying the target of every link"""
+    from utils import DocLink, DocPath, resolve_url
+
+    doc_paths = [DocPath(path) for path in paths]
+    links = [
+        (doc_path.new_path.parent, link.url)
+        for doc_path in doc_paths
+        for line in doc_path.content
+        for link in DocLink.get_links(line)
+    ]
+
+    uncached = resolve_url.__wrapped__
+    before = timed("uncached", lambda link: uncached(*link), links, 3, clear_caches, "links")
+    after = timed("cached", lambda link: resolve_url(*link), links, 3, clear_caches, "links")
+    print(f"speedup                  {before / after:8.2f}x")
+
+
+def bench_graph(paths: List[Path], args: argparse.Namespace):
+    """accumulating the knowledge graph and writing graph_info.js"""
+    from utils import DocLink, DocPath, GraphBuilder, Settings, parse_graph
+
+    Settings.parse_env()
+    pages = []
+    for path in paths:
+        doc_path = DocPath(path)
+        _, links = DocLink.parse_lines(doc_path.content, doc_path)
+        pages.append((doc_path.abs_url, doc_path.page_title, [doc_path.edge(link) for link in links]))
+
+    def build_graph():
+        graph = GraphBuilder()
+        for url, title, edges in pages:
+            graph.add_node(url, title)
+            for edge in edges:
+                graph.add_edge(edge)
+        return graph.build()
+
+    start = time.perf_counter()
+    graph = build_graph()
+    record("accumulate", time.perf_counter() - start, len(pages))
+    start = time.perf_counter()
+    parse_graph(graph)
+    record("parse_graph", time.perf_counter() - start, len(pages))
+
+
+def bench_build(paths: List[Path], args: argparse.Namespace):
+    """convert.main end to end: a full build, then a rebuild with nothing changed"""
+    import convert
+
+    argv = sys.argv
+    try:
+        for label, flags in (("full", ["--full"]), ("unchanged", [])):
+            sys.argv = ["convert.py", "--quiet", "--jobs", str(args.jobs), *flags]
+            start = time.perf_counter()
+            convert.main()
+            record(label, time.perf_counter() - start, len(paths))
+    finally:
+        sys.argv = argv
+
+
+def bench_startup(paths: List[Path], args: argparse.Namespace):
+    """importing convert in a fresh interpreter, and turning every page's frontmatter into html"""
+    import subprocess
+
+    command = [sys.executable, "-c", "import convert"]
+    here = Path(__file__).parent
+    timed("import convert", lambda _: subprocess.run(command, cwd=here, check=True), [None], 5, unit="imports")
+
+    # -X importtime lines are "import time: self | cumulative | name", nested names indented
+    lines = subprocess.run(
+        [sys.executable, "-X", "importtime", *command[1:]], cwd=here, check=True, capture_output=True, text=True,
+    ).stderr.splitlines()
+    imports = []
+    for line in lines[1:]:
+        _, cumulative, name = line.split("|")
+        if len(name) - len(name.lstrip()) == 3:
+            imports.append((int(cumulative), name.strip()))
+    for cumulative, name in sorted(imports, reverse=True)[:5]:
+        print(f"  {name:<22} {cumulative / 1000:8.1f} ms")
+
+    from utils import DocPath, convert_metadata_to_html
+
+    frontmatters = [DocPath(path).frontmatter for path in paths]
+    timed("metadata html", convert_metadata_to_html, frontmatters, 3)
+
+
+def clear_caches():
+    from utils import resolve_url, slugify_component
+
+    resolve_url.cache_clear()
+    slugify_component.cache_clear()
+
+
+BENCHMARKS = {
+    "load": bench_load,
+    "frontmatter": bench_frontmatter,
+    "links": bench_links,
+    "urls": bench_urls,
+    "graph": bench_graph,
+    "build": bench_build,
+    "startup": bench_startup,
+}
+
+# ---------------------------------------------------------------------------- #
+#                                    Results                                   #
+# ---------------------------------------------------------------------------- #
+
+def run_child(name: str, paths: List[Path], args: argparse.Namespace, queue: multiprocessing.Queue):
+    BENCHMARKS[name](paths, args)
+    queue.put(RESULTS)
+
+
+def run_isolated(name: str, paths: List[Path], args: argparse.Namespace) -> List[dict]:
+    """runs a benchmark in a fresh process, returns what it recorded"""
+    queue: multiprocessing.Queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_child, args=(name, paths, args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        sys.exit(f"benchmark {name} failed")
+    return [{"benchmark": name, **result} for result in queue.get()]
+
+
+def compare_results(results: List[dict], params: dict, baseline_path: Path, tolerance: float) -> bool:
+    """prints time ratios against an earlier run, false if anything got slower than tolerance"""
+    saved = json.loads(baseline_path.read_text())
+    baseline = {(result["benchmark"], result["label"]): result for result in saved["results"]}
+    ok = True
+    print(f"\ncompared to {baseline_path}")
+    if saved["params"] != params:
+        print("warning: it was generated with different parameters")
+    for result in results:
+        old = baseline.get((result["benchmark"], result["label"]))
+        if old is None:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        regressed = ratio > 1 + tolerance
+        ok = ok and not regressed
+        label = f"{result['benchmark']}/{result['label']}"
+        print(f"{label:<30} {ratio:6.2f}x time  {result['peak_rss_mb'] - old['peak_rss_mb']:+8.1f} MB{'  REGRESSION' if regressed else ''}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", help=f"any of: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("--notes", type=int, default=2000)
+    parser.add_argument("--links", type=int, default=20, help="links per note")
+    parser.add_argument("--per-line", type=int, default=1, help="links per line")
+    parser.add_argument("--fields", type=int, default=1, help="extra frontmatter keys per note")
+    parser.add_argument("--tag-skew", type=float, default=0.0, help="zipf exponent of the tag distribution, 0 for uniform")
+    parser.add_argument("--resources", type=int, default=0, help="images embedded by the notes")
+    parser.add_argument("--depth", type=int, default=1, help="levels of nested folders")
+    parser.add_argument("--fanout", type=int, default=4, help="subfolders per folder")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for the build benchmark")
+    parser.add_argument("--json", type=Path, help="save results to this file")
+    parser.add_argument("--compare", type=Path, help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown that counts as a regression")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["BUILD_DIR"] = tmp
+        prepare_site(Path(tmp))
+        paths = generate_vault(
+            Path(tmp) / "__vault_export", args.notes, args.links, args.seed, args.per_line,
+            args.fields, args.tag_skew, args.resources, args.depth, args.fanout,
+        )
+        print(f"generated {len(paths)} notes with {args.links} links each and {args.resources} resources")
+
+        for name in args.benchmarks or BENCHMARKS:
+            print(f"\n{name}: {BENCHMARKS[name].__doc__}")
+            results.extend(run_isolated(name, paths, args))
+
+    params = {
+        key: value for key, value in vars(args).items()
+        if key not in ("benchmarks", "json", "compare", "tolerance")
+    }
+    if args.json:
+        args.json.write_text(json.dumps({
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": params,
+            "results": results,
+        }, indent=2))
+        print(f"\nsaved {args.json}")
+
+    if args.compare and not compare_results(results, params, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
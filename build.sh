@@ -1,4 +1,6 @@
 #!/bin/bash
+# builds the site. sourced (. ./build.sh) it only picks $PYTHON and defines the steps,
+# so tmux.sh can run them again on changes
 
 die() {
 	echo >&2 error: "$@"
@@ -9,10 +11,53 @@ check_prog() {
 	command -v "$1" >/dev/null 2>&1 || die "program '$1' is required, but wasn't found"
 }
 
-check_prog zola
-check_prog rsync
-check_prog python
-check_prog obsidian-export
+# times a command when PROFILE_BUILD is set, convert.py profiles its own stages
+stage() {
+	local name=$1
+	shift
+	if [ -n "$PROFILE_BUILD" ]; then
+		local TIMEFORMAT="stage $name: %3Rs"
+		time "$@"
+	else
+		"$@"
+	fi
+}
+
+# zola config, theme and static content into build/
+copy_theme() {
+	local ZOLACFG="config.toml"
+
+	if ! test -f "$ZOLACFG"; then
+		if ! test -f "$VAULT/config.toml"; then
+			echo "Zola configuration file not found, using default settings";
+			ZOLACFG="./${ZOLACFG}.sample";
+		else
+			echo "Zola configuration file found in vault";
+			ZOLACFG="$VAULT/config.toml";
+		fi;
+	fi
+
+	mkdir -p build
+
+	stage rsync rsync -a "$ZOLACFG" build/config.toml
+	stage rsync rsync -a "${THEME}/" build/
+	stage rsync rsync -a content/ build/content
+}
+
+# obsidian-export dumps to temp dir
+export_vault() {
+	mkdir -p build/__vault_export
+	if [ -z "$STRICT_LINE_BREAKS" ]; then
+		stage obsidian-export obsidian-export --hard-linebreaks --no-recursive-embeds "$VAULT" build/__vault_export
+	else
+		stage obsidian-export obsidian-export --no-recursive-embeds "$VAULT" build/__vault_export
+	fi
+}
+
+# converts the export into build/content, also fills in the theme's placeholders
+convert_vault() {
+	stage convert "$PYTHON" convert.py --jobs "${JOBS:-1}" ${STRICT_LINKS:+--strict} "$@" || die "convert.py failed"
+}
 
 if [ -d "venv" ]; then
     PYTHON="venv/bin/python"
@@ -22,6 +67,13 @@ else
     PYTHON="python"
 fi
 
+[ "${BASH_SOURCE[0]}" != "$0" ] && return 0
+
+check_prog zola
+check_prog rsync
+check_prog python
+check_prog obsidian-export
+
 echo "${VAULT:?}"
 echo "${SITE_URL:?}"
 echo "${REPO_URL:?}"
@@ -29,32 +81,8 @@ echo "${LANDING_PAGE:?}"
 echo "${PYTHON:?}"
 echo "${THEME:?}"
 
-ZOLACFG="config.toml"
-
-if ! test -f "$ZOLACFG"; then
-	if ! test -f "$VAULT/config.toml"; then
-		echo "Zola configuration file not found, using default settings";
-		ZOLACFG="./${ZOLACFG}.sample";
-	else
-		echo "Zola configuration file found in vault";
-		ZOLACFG="$VAULT/config.toml";
-	fi;
-fi
-
-mkdir -p build
-
-rsync -a "$ZOLACFG" build/config.toml
-rsync -a "${THEME}/" build/
-rsync -a content/ build/content
-
-# obsidian-export dumps to temp dir
-mkdir -p build/__vault_export
-if [ -z "$STRICT_LINE_BREAKS" ]; then
-	obsidian-export --hard-linebreaks --no-recursive-embeds "$VAULT" build/__vault_export
-else
-	obsidian-export --no-recursive-embeds "$VAULT" build/__vault_export
-fi
-
-$PYTHON convert.py
+copy_theme
+export_vault
+convert_vault
 
-zola --root build build "$@"
\ No newline at end of file
+stage zola zola --root build build "$@"
@@ -1,20 +1,64 @@
-import re
+import argparse
+import hashlib
+import json
+import logging
+import os
+import signal
+import sys
+import time
 import metadata_handlers
-from typing import Dict, List, Optional, Tuple
+from dataclasses import asdict, dataclass, field
+from itertools import chain
+from pathlib import Path
+from stat import S_ISREG
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import quote
 
 from utils import (
     DocLink,
     DocPath,
+    GraphBuilder,
+    Manifest,
+    Profiler,
+    RESPONSIVE_EXTENSIONS,
     Settings,
+    STREAM_THRESHOLD,
+    cache_stats,
+    output_stats,
     convert_metadata_to_html,
     parse_graph,
-    pp,
+    prune_image_cache,
+    register_metadata_handler,
+    remove_shards,
+    registered_handlers,
     raw_dir,
+    scan_tree,
+    setup_logging,
     site_dir,
     content_dir,
+    file_digest,
+    handler_versions,
+    ignore_rules,
+    index_page,
+    is_ignored,
+    log,
+    write_search_index,
     write_settings,
+    write_stream,
+    write_text,
 )
 
+# a path with the stat it was found with, None to stat it when converted
+ScannedPath = Tuple[Path, Optional[os.stat_result]]
+
+# paths per task sent to a pool worker, small so workers start while the walk goes on.
+# chunks are cut early at CHUNK_BYTES of files so large images spread over the workers
+CHUNK_PATHS = 32
+CHUNK_BYTES = 4 << 20
+
+# written to site_dir on every build, see check_links
+LINK_REPORT = "link-report.json"
+
 # tag -> section mapping
 TAG_TO_DIR = {
     "book": "reviews",
@@ -24,6 +68,18 @@ TAG_TO_DIR = {
     "fieldnote": "fieldnotes",
 }
 
+# frontmatter line holding a page's incoming links, rewritten in place when they change
+BACKLINKS_KEY = "    backlinks: "
+# frontmatter line holding the links a page's readers are likely to follow, best first
+PRERENDER_KEY = "    prerender: "
+# the lines process_page writes last in a page's extra frontmatter, after the note's own
+# keys, so a note with its own prerender or backlinks key can't be mistaken for them
+TRAILING_KEYS = (PRERENDER_KEY, BACKLINKS_KEY)
+
+# page url -> degree in the knowledge graph of the last build, 0 for pages not in it.
+# pages rank their prerender links with these when written, see update_prerender
+page_degrees: Dict[str, int] = {}
+
 # section -> template mapping
 SECTION_TEMPLATES = {
     'reviews': {
@@ -65,86 +121,694 @@ def get_templates(section: Optional[str]) -> Dict[str, str]:
     return DEFAULT_TEMPLATES
 
 
+@dataclass
+class PathResult:
+    """what converting one exported path produced, cached in the manifest"""
+    hash: str
+    frontmatter: Optional[str] = None
+    url: Optional[str] = None
+    output: Optional[str] = None
+    title: Optional[str] = None
+    links: List[str] = field(default_factory=list)
+    bad_links: int = 0
+    backlinks: Dict[str, str] = field(default_factory=dict)
+    nodes: Dict[str, str] = field(default_factory=dict)
+    edges: List[Tuple[str, str]] = field(default_factory=list)
+    sections: Dict[str, str] = field(default_factory=dict)
+    terms: Dict[str, int] = field(default_factory=dict)
+    summary: str = ""
+    variants: List[str] = field(default_factory=list)
+    prerender: List[str] = field(default_factory=list)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "PathResult":
+        result = cls(**data)
+        result.edges = [tuple(edge) for edge in result.edges]
+        return result
+
+
 def main():
+    parser = argparse.ArgumentParser(description="converts exported obsidian vault to zola content")
+    parser.add_argument("--jobs", "-j", type=int, default=1, help="worker processes, 0 for one per core")
+    parser.add_argument("--full", action="store_true", help="ignore the manifest and convert every path")
+    parser.add_argument("--verbose", "-v", action="store_true", help="log every path, link and section")
+    parser.add_argument("--quiet", "-q", action="store_true", help="log warnings and errors only")
+    parser.add_argument("--watch", "-w", action="store_true", help="keep converting changes to the export")
+    parser.add_argument("--debounce", type=float, default=0.1, help="seconds of quiet before a change is converted")
+    parser.add_argument("--poll", type=float, help="poll for changes at this interval instead of inotify")
+    parser.add_argument("--strict", action="store_true", help="fail on broken or dangling links")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else log_level()
+    setup_logging(level)
+
     Settings.parse_env()
-    Settings.sub_file(site_dir / "config.toml")
-    Settings.sub_file(site_dir / "content/_index.md")
-    Settings.sub_file(site_dir / "static/js/graph.js")
-
-    nodes: Dict[str, str] = {}
-    edges: List[Tuple[str, str]] = []
-    seen_sections = set()
-
-    all_paths = list(sorted(raw_dir.glob("**/*")))
-
-    for path in [raw_dir, *all_paths]:
-        doc_path = DocPath(path)
-        
-        if doc_path.is_file:
-            if doc_path.is_md:
-                process_page(doc_path, nodes, edges, seen_sections)
-            else:
-                doc_path.copy()
-                print(f"found resource: {doc_path.new_rel_path}")
+    with Profiler.stage("sub_file"):
+        Settings.sub_theme()
+
+    with Profiler.stage("manifest"):
+        manifest = Manifest.load()
+    previous = {
+        key: PathResult.from_dict(entry) for key, entry in manifest.paths.items()
+    } if manifest.version == build_version() else {}
+    cached = {} if args.full else previous
+    # pages are written with what the previous build found out, update fixes what changed
+    DocLink.plain_images = plain_images(previous.values())
+    page_degrees.update(manifest_degrees(list(manifest.paths.values())))
+
+    jobs = args.jobs or os.cpu_count() or 1
+    results, stats, affected = update({}, cached, scan_export(raw_dir), jobs)
+    old_outputs = [
+        output for entry in manifest.paths.values() for output in [entry.get("output"), *entry.get("variants", [])]
+    ]
+    report = write_site(results, stats, affected, start, old_outputs)
+
+    try:
+        if args.strict and (report["broken"] or report["dangling"]):
+            log.error("--strict: broken or dangling links, see %s", site_dir / LINK_REPORT)
+            sys.exit(1)
+        if args.watch:
+            # a terminated daemon still saves its manifest
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            watch_vault(results, args.debounce, args.poll)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        with Profiler.stage("manifest"):
+            Manifest(build_version(), {key: asdict(result) for key, (result, _) in results.items()}).save()
+        Profiler.report(site_dir)
+
+
+def update(
+    kept: Dict[str, PathResult], previous: Dict[str, PathResult], paths: Iterable[ScannedPath], jobs: int
+) -> Tuple[Dict[str, Tuple[PathResult, bool]], Dict[str, Tuple[int, int]], int]:
+    """converts paths unless their previous result is still valid, on top of the kept
+    results of paths not looked at. then converts pages again that link to a page whose
+    url or frontmatter changed or that is gone, or that embed an image whose variants
+    came or went. also returns stats and how many pages that affected"""
+    results = {key: (result, False) for key, result in kept.items()}
+    converted, stats = convert_all(paths, previous, jobs)
+    results.update(converted)
+
+    # pages linking to a page whose url or frontmatter changed are converted again
+    changed_urls = set()
+    for key, (result, converted) in results.items():
+        old = previous.get(key)
+        if converted and (old is None or (old.url, old.frontmatter) != (result.url, result.frontmatter)):
+            changed_urls.update({result.url, old.url if old else None})
+    for key in previous.keys() - results.keys():
+        changed_urls.add(previous[key].url)
+    changed_urls.discard(None)
+
+    affected = [
+        (raw_dir / key, None) for key, (result, converted) in results.items()
+        if not converted and not changed_urls.isdisjoint(result.links)
+    ]
+    affected_results, affected_stats = convert_all(affected, {}, jobs)
+    results.update(affected_results)
+
+    # pages were written with the DocLink.plain_images of the previous build, now that
+    # every image is converted the ones embedding an image that changed are written again
+    plain = plain_images(result for result, _ in results.values())
+    changed_images = plain ^ DocLink.plain_images
+    DocLink.plain_images = plain
+    embedding = [
+        (raw_dir / key, None) for key, (result, _) in results.items()
+        if not changed_images.isdisjoint(result.links)
+    ]
+    embedding_results, embedding_stats = convert_all(embedding, {}, jobs)
+    results.update(embedding_results)
+
+    before = output_stats()
+    with Profiler.stage("backlinks"):
+        update_backlinks(previous, results)
+    stats = add_stats(stats, affected_stats, embedding_stats, diff_stats(before, output_stats()))
+    return results, stats, len(affected) + len(embedding)
+
+
+def plain_images(results: Iterable[PathResult]) -> Set[str]:
+    """urls of the images pages embed that have no IMAGE_WIDTHS variants, because
+    making them failed or nothing was exported there"""
+    if not Settings.options["IMAGE_WIDTHS"]:
+        return set()
+    results = list(results)
+    variants = {quote(f"/{result.output}") for result in results if result.variants}
+    return {
+        link for result in results for link in result.links
+        if link not in variants and link.lower().endswith(RESPONSIVE_EXTENSIONS)
+    }
+
+
+def update_backlinks(previous: Dict[str, PathResult], results: Dict[str, Tuple[PathResult, bool]]):
+    """inverts links into each page's backlinks (source url -> title). starts from the
+    backlinks of the previous results and only applies the links of pages converted or
+    removed since, then rewrites the backlinks line of pages whose backlinks changed"""
+    index: Dict[str, Dict[str, str]] = {
+        result.url: dict(result.backlinks) for result in previous.values() if result.url
+    }
+    sources = [key for key, (_, converted) in results.items() if converted]
+    sources.extend(previous.keys() - results.keys())
+    for key in sources:
+        old = previous.get(key)
+        if old is not None and old.url:
+            for target in set(old.links):
+                index.get(target, {}).pop(old.url, None)
+    for key in sources:
+        if key in results:
+            new, _ = results[key]
+            if new.url:
+                for target in set(new.links) - {new.url}:
+                    index.setdefault(target, {})[new.url] = new.title
 
-    pp(nodes)
-    pp(edges)
-    parse_graph(nodes, edges)
+    for result, _ in results.values():
+        if result.url is None or result.output is None:
+            continue
+        backlinks = dict(sorted(index.get(result.url, {}).items(), key=lambda item: (item[1].lower(), item[0])))
+        if list(backlinks.items()) != list(result.backlinks.items()):
+            replace_line(content_dir / result.output, BACKLINKS_KEY, backlinks_line(backlinks))
+            result.backlinks = backlinks
+            log.debug("backlinks of %s: %d", result.url, len(backlinks))
+
+
+def update_prerender(results: Dict[str, Tuple[PathResult, bool]], degrees: Dict[str, int]):
+    """ranks every page's links for speculative loading, see rank_links, and rewrites the
+    prerender line of pages whose list changed. degrees are the graph's, so a page's
+    list changes when the pages it links to gain or lose links. pages were ranked with
+    page_degrees when written, which then become these"""
+    limit = int(Settings.options["PRERENDER_LIMIT"] or 0)
+    pages = {
+        result.url: degrees.get(result.url, 0) for result, _ in results.values() if result.url is not None
+    }
+    for result, _ in results.values():
+        if result.url is None or result.output is None:
+            continue
+        ranked = rank_links(result.url, result.links, pages, limit)
+        if ranked != result.prerender:
+            replace_line(content_dir / result.output, PRERENDER_KEY, prerender_line(ranked))
+            result.prerender = ranked
+    page_degrees.clear()
+    page_degrees.update(pages)
+
+
+def manifest_degrees(entries: List[dict]) -> Dict[str, int]:
+    """page_degrees of the build that wrote manifest entries, of any version"""
+    graph = GraphBuilder()
+    for entry in entries:
+        for url, title in entry.get("nodes", {}).items():
+            graph.add_node(url, title)
+        for edge in entry.get("edges", []):
+            graph.add_edge(tuple(edge))
+    built = graph.build()
+    degrees = dict(zip(built.urls, built.degrees))
+    return {entry["url"]: degrees.get(entry["url"], 0) for entry in entries if entry.get("url")}
+
+
+def rank_links(url: str, links: List[str], pages: Dict[str, int], limit: int) -> List[str]:
+    """the limit best of the distinct pages url links to, pages mapping each page to its
+    degree in the graph. a target scores its degree plus one over its position among
+    them (1 for the first), ties keep page order"""
+    targets = list(dict.fromkeys(link for link in links if link in pages and link != url))
+    scores = [(pages[target] + 1) / (position + 1) for position, target in enumerate(targets)]
+    order = sorted(range(len(targets)), key=lambda position: -scores[position])
+    return [targets[position] for position in order[:limit]]
+
+
+def replace_line(path: Path, key: str, line: str):
+    """rewrites one of the TRAILING_KEYS lines of a page's output, found by its place
+    before the closing "---" rather than by name"""
+    back = len(TRAILING_KEYS) - TRAILING_KEYS.index(key)
+    if path.stat().st_size > STREAM_THRESHOLD:
+        write_stream(path, replace_line_stream(path, key, line, back))
+    else:
+        text = path.read_text(encoding="utf-8")
+        end = start = text.index("\n---\n", 3)
+        for _ in range(back):
+            end, start = start, text.rindex("\n", 0, start)
+        if not text.startswith(key, start + 1):
+            raise ValueError(f"{path}: no {key.strip()} line where it was written")
+        write_text(path, text[:start + 1] + line + text[end:])
+
+
+def replace_line_stream(path: Path, key: str, line: str, back: int) -> Iterator[str]:
+    """a large page's output with the frontmatter line back lines before the closing
+    "---" replaced, in chunks"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        head = [f.readline()]
+        for row in f:
+            head.append(row)
+            if row == "---\n":
+                break
+        start = len(head) - 1 - back
+        if not head[start].startswith(key):
+            raise ValueError(f"{path}: no {key.strip()} line where it was written")
+        head[start] = line + "\n"
+        yield "".join(head)
+        yield from iter(lambda: f.read(1 << 20), "")
+
+
+def prerender_line(links: List[str]) -> str:
+    return PRERENDER_KEY + json.dumps(links, ensure_ascii=False)
+
+
+def written_backlinks(path: Path) -> Dict[str, str]:
+    """the backlinks in the frontmatter of a page's existing output, none without one.
+    a page converted without its manifest entry (--full, a new build version, a page
+    affected by changed links) is written with these, so an unchanged page's output
+    doesn't change and isn't rewritten by update_backlinks"""
+    last = ""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            f.readline()
+            for row in f:
+                if row == "---\n":
+                    break
+                last = row
+            if not last.startswith(BACKLINKS_KEY):
+                return {}
+            items = json.loads(last[len(BACKLINKS_KEY):])
+            return {item["url"]: item["title"] for item in items}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def backlinks_line(backlinks: Dict[str, str]) -> str:
+    """last line of a page's extra frontmatter, json being valid yaml"""
+    items = [{"url": url, "title": title} for url, title in backlinks.items()]
+    return BACKLINKS_KEY + json.dumps(items, ensure_ascii=False)
+
+
+def write_site(
+    results: Dict[str, Tuple[PathResult, bool]],
+    stats: Dict[str, Tuple[int, int]],
+    affected: int,
+    start: float,
+    old_outputs: Iterable[Optional[str]],
+    graph_changed: bool = True,
+    search_changed: bool = True,
+) -> Dict[str, Any]:
+    """removes stale outputs, writes tag sections, the graph, the search index, settings
+    and the link report, ranks prerender links, logs a summary. returns the link report"""
+    remove_stale_outputs(old_outputs, results)
+
+    graph = GraphBuilder()
+    sections: Dict[str, str] = {}
+
+    with Profiler.stage("merge"):
+        for key in sorted(results):
+            result, _ = results[key]
+            for url, title in result.nodes.items():
+                graph.add_node(url, title)
+            for edge in result.edges:
+                graph.add_edge(edge)
+            for section, template in result.sections.items():
+                sections.setdefault(section, template)
+        built = graph.build()
+
+    before = output_stats()
+    with Profiler.stage("sections"):
+        for section, template in sections.items():
+            create_tag_section(section, template)
+
+    for name in ("url", "slug"):
+        log.debug("%s cache: %d hits, %d misses", name, *stats[name])
+
+    if graph_changed:
+        with Profiler.stage("parse_graph"):
+            parse_graph(built)
+    with Profiler.stage("prerender"):
+        update_prerender(results, dict(zip(built.urls, built.degrees)))
+    if not Settings.is_true("SEARCH_INDEX"):
+        remove_shards(site_dir / "static/search")
+    elif search_changed:
+        with Profiler.stage("search_index"):
+            write_search_index([
+                (result.url, result.title, result.summary, result.terms)
+                for result, _ in results.values() if result.url is not None
+            ])
+    if Settings.options["IMAGE_WIDTHS"]:
+        prune_image_cache(result.hash for result, _ in results.values() if result.variants)
     write_settings()
+    with Profiler.stage("check_links"):
+        report = check_links(results)
+        write_text(site_dir / LINK_REPORT, json.dumps(report, indent=1))
+    stats = add_stats(stats, diff_stats(before, output_stats()))
+
+    summarize(results, stats, affected, report, time.perf_counter() - start)
+    return report
+
+
+def check_links(results: Dict[str, Tuple[PathResult, bool]]) -> Dict[str, Any]:
+    """checks every page's links against the set of urls the build emits (pages, resources,
+    tag sections), one lookup each. links are the strings resolve_url cached, so nothing is
+    resolved again. reports pages with broken links (unresolvable, rendered as /404), the
+    dangling links of each page (resolved to nothing the build wrote) and orphan pages no
+    other page links to"""
+    targets = set()
+    for result, _ in results.values():
+        if result.url is not None:
+            targets.add(result.url)
+        elif result.output is not None:
+            targets.add(quote(f"/{result.output}"))
+        targets.update(f"/{section}" for section in result.sections)
 
+    broken: Dict[str, int] = {}
+    dangling: Dict[str, List[str]] = {}
+    orphans: List[str] = []
+    for result, _ in results.values():
+        if result.url is None:
+            continue
+        if result.bad_links:
+            broken[result.url] = result.bad_links
+        missing = {link for link in result.links if link not in targets and link != "/404"}
+        if missing:
+            dangling[result.url] = sorted(missing)
+        if not result.backlinks:
+            orphans.append(result.url)
+    return {
+        "links": sum(len(result.links) for result, _ in results.values()),
+        "broken": dict(sorted(broken.items())),
+        "dangling": dict(sorted(dangling.items())),
+        "orphans": sorted(orphans),
+    }
 
-def process_page(
-    doc_path: DocPath, 
-    nodes: Dict[str, str], 
-    edges: List[Tuple[str, str]],
-    seen_sections: set
+
+def watch_vault(results: Dict[str, Tuple[PathResult, bool]], debounce: float, poll: Optional[float]):
+    """converts changes to the export as they happen, from results kept in memory.
+    changed paths and pages linking to them are converted, the graph is only
+    written again when a page's nodes or edges changed"""
+    import watcher
+
+    log.info("watching %s", raw_dir)
+    for changed in watcher.watch(raw_dir, debounce, poll):
+        start = time.perf_counter()
+        previous = {key: result for key, (result, _) in results.items()}
+        if raw_dir in changed:
+            # inotify lost events, look at everything again
+            changed = {raw_dir}
+        changed = {path for path in changed if not ignored(path)}
+        if not changed:
+            continue
+        touched = {str(path.relative_to(raw_dir)) for path in changed}
+        kept = {
+            key: result for key, result in previous.items()
+            if key not in touched and touched.isdisjoint(map(str, Path(key).parents))
+        }
+        paths: Dict[Path, Optional[os.stat_result]] = {}
+        for path in changed:
+            if path.is_dir():
+                paths.update(scan_export(path))
+            elif path.exists():
+                paths[path] = None
+
+        # results is updated in place so main saves the latest state on exit
+        updated, stats, affected = update(kept, previous, sorted(paths.items(), key=lambda item: item[0]), 1)
+        results.clear()
+        results.update(updated)
+        graph_changed = any(
+            key not in previous or (result.nodes, result.edges) != (previous[key].nodes, previous[key].edges)
+            for key, (result, converted) in results.items() if converted
+        ) or any(previous[key].nodes for key in previous.keys() - results.keys())
+        search_changed = any(converted for _, converted in results.values()) or previous.keys() != results.keys()
+        write_site(
+            results, stats, affected, start,
+            [output for result in previous.values() for output in [result.output, *result.variants]],
+            graph_changed, search_changed,
+        )
+
+
+def scan_export(root: Path) -> Iterator[ScannedPath]:
+    """paths under root, the export or a directory in it, with their stats as they are
+    found, minus those IGNORE_PATTERNS excludes"""
+    rel_path = root.relative_to(raw_dir).as_posix()
+    prefix = "" if rel_path == "." else rel_path + "/"
+    return scan_tree(root, ignore_rules(Settings.options["IGNORE_PATTERNS"]), prefix)
+
+
+def ignored(path: Path) -> bool:
+    """whether IGNORE_PATTERNS excludes a path in the export or a directory it is in"""
+    rules = ignore_rules(Settings.options["IGNORE_PATTERNS"])
+    rel_path = path.relative_to(raw_dir)
+    return any(
+        is_ignored(parent.as_posix(), True, rules) for parent in reversed(rel_path.parents[:-1])
+    ) or (rel_path.parts != () and is_ignored(rel_path.as_posix(), path.is_dir(), rules))
+
+
+def log_level() -> int:
+    """LOG_LEVEL from the environment (debug, info, warning, error), info by default.
+    read outside Settings.options so it doesn't change the manifest version"""
+    level = logging.getLevelName(os.environ.get("LOG_LEVEL", "info").upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+def summarize(
+    results: Dict[str, Tuple[PathResult, bool]],
+    stats: Dict[str, Tuple[int, int]],
+    affected: int,
+    report: Dict[str, Any],
+    elapsed: float,
+):
+    """the lines a default build prints"""
+    pages = sum(result.url is not None for result, _ in results.values())
+    resources = sum(not key.endswith(".md") for key in results)
+    skipped = len(results) - pages - resources
+    converted = sum(converted for _, converted in results.values())
+    bad_links = sum(report["broken"].values())
+    dangling = sum(len(links) for links in report["dangling"].values())
+    log.info(
+        "%d pages, %d resources, %d skipped, %d bad links, %d dangling, %d orphans; converted "
+        "%d of %d paths (%d affected by changed links) in %.2fs",
+        pages, resources, skipped, bad_links, dangling, len(report["orphans"]), converted,
+        len(results), affected, elapsed,
+    )
+    log.info(
+        "%d of %d writes unchanged, %d of %d resources linked or unchanged, %.1f MB not written",
+        stats["writes"][0], sum(stats["writes"]), stats["resources"][0], sum(stats["resources"]),
+        stats["bytes"][0] / (1 << 20),
+    )
+
+
+def build_version() -> str:
+    """hash of settings, converter source and registered metadata handlers, any change
+    invalidates the manifest"""
+    digest = hashlib.sha1(json.dumps(Settings.options, sort_keys=True).encode())
+    for module in ("convert.py", "utils.py", "metadata_handlers.py"):
+        digest.update((Path(__file__).parent / module).read_bytes())
+    digest.update(handler_versions().encode())
+    return digest.hexdigest()
+
+
+def convert_all(
+    paths: Iterable[ScannedPath], cached: Dict[str, PathResult], jobs: int
+) -> Tuple[Dict[str, Tuple[PathResult, bool]], Dict[str, Tuple[int, int]]]:
+    """converts paths as they come, in a process pool when jobs > 1 and there are more
+    than CHUNK_PATHS, keyed by path relative to raw_dir. also returns the cache and
+    output stats this took"""
+    tasks = ((path, stat, cached.get(str(path.relative_to(raw_dir)))) for path, stat in paths)
+    chunks = chunk_tasks(tasks)
+    first = next(chunks, [])
+    second = next(chunks, None)
+
+    if jobs > 1 and second is not None:
+        from concurrent.futures import ProcessPoolExecutor
+
+        # chunks come back in path order, so merging is deterministic
+        chunks = chain([first, second], chunks)
+        initargs = (
+            Settings.options, log.getEffectiveLevel(), registered_handlers, DocLink.plain_images, page_degrees
+        )
+        with ProcessPoolExecutor(jobs, initializer=init_worker, initargs=initargs) as pool:
+            converted = list(pool.map(convert_chunk, chunks))
+        outcomes = [outcome for chunk_outcomes, _, _ in converted for outcome in chunk_outcomes]
+        stats = add_stats(*(chunk_stats for _, chunk_stats, _ in converted))
+        for _, _, profile in converted:
+            Profiler.merge(profile)
+    else:
+        outcomes, stats, profile = convert_chunk(chain(first, second or [], chain.from_iterable(chunks)))
+        Profiler.merge(profile)
+
+    results = {
+        str(path.relative_to(raw_dir)): outcome
+        for path, outcome in outcomes
+        if outcome is not None
+    }
+    return results, stats
+
+
+def chunk_tasks(
+    tasks: Iterable[Tuple[Path, Optional[os.stat_result], Optional[PathResult]]]
+) -> Iterator[List[Tuple[Path, Optional[os.stat_result], Optional[PathResult]]]]:
+    """cuts tasks into chunks of CHUNK_PATHS paths or CHUNK_BYTES of files they were
+    found with, whichever comes first"""
+    chunk = []
+    size = 0
+    for task in tasks:
+        chunk.append(task)
+        size += task[1].st_size if task[1] is not None else 0
+        if len(chunk) == CHUNK_PATHS or size >= CHUNK_BYTES:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def convert_chunk(
+    tasks: Iterable[Tuple[Path, Optional[os.stat_result], Optional[PathResult]]]
+) -> Tuple[List[Tuple[Path, Optional[Tuple[PathResult, bool]]]], Dict[str, Tuple[int, int]], Optional[dict]]:
+    """converts a chunk of paths, returns each path with its outcome, the cache and
+    output stats they added and what the profiler recorded meanwhile"""
+    before = {**cache_stats(), **output_stats()}
+    outcomes = [(path, convert_path(path, stat, entry)) for path, stat, entry in tasks]
+    after = {**cache_stats(), **output_stats()}
+    return outcomes, diff_stats(before, after), Profiler.drain()
+
+
+def diff_stats(
+    before: Dict[str, Tuple[int, int]], after: Dict[str, Tuple[int, int]]
+) -> Dict[str, Tuple[int, int]]:
+    return {
+        name: (hits - before[name][0], misses - before[name][1])
+        for name, (hits, misses) in after.items()
+    }
+
+
+def add_stats(*stats: Dict[str, Tuple[int, int]]) -> Dict[str, Tuple[int, int]]:
+    """sums stat pairs (cache hits and misses, output avoided and done) by name"""
+    total: Dict[str, Tuple[int, int]] = {}
+    for item in stats:
+        for name, (hits, misses) in item.items():
+            total_hits, total_misses = total.get(name, (0, 0))
+            total[name] = (total_hits + hits, total_misses + misses)
+    return total
+
+
+def remove_stale_outputs(outputs: Iterable[Optional[str]], results: Dict[str, Tuple[PathResult, bool]]):
+    """deletes outputs of removed paths and of paths whose output moved"""
+    current = {output for result, _ in results.values() for output in [result.output, *result.variants]}
+    for output in outputs:
+        if output and output not in current:
+            (content_dir / output).unlink(missing_ok=True)
+            log.debug("removed stale output: %s", output)
+
+
+def init_worker(
+    options: Dict[str, Optional[str]],
+    level: int,
+    handlers: Dict[str, Callable[[Any], Any]],
+    plain_images: Set[str],
+    degrees: Dict[str, int],
 ):
-    """process markdown page with tag-based routing"""
-    content = doc_path.content
-    print(f'content {len(content)} lines for {doc_path.page_title}')
+    """gives pool workers the parent's settings, log level, registered metadata handlers,
+    images without variants and page_degrees, needed when processes are spawned. forked
+    workers also drop what the parent profiled so far"""
+    Settings.options.update(options)
+    for key, handler in handlers.items():
+        register_metadata_handler(key, handler)
+    DocLink.plain_images = plain_images
+    page_degrees.update(degrees)
+    setup_logging(level)
+    Profiler.drain()
+
+
+def convert_path(
+    path: Path, stat: Optional[os.stat_result] = None, cached: Optional[PathResult] = None
+) -> Optional[Tuple[PathResult, bool]]:
+    """converts one exported path, found with stat if given, unless its cached result is
+    still valid. returns the result and whether it was converted, None for directories"""
+    if stat is not None and not S_ISREG(stat.st_mode):
+        return None
+    doc_path = DocPath(path, stat=stat)
+
+    if not doc_path.is_file:
+        return None
+
+    with Profiler.stage("page", str(path.relative_to(raw_dir))):
+        with Profiler.stage("read"):
+            digest = doc_path.document.digest if doc_path.is_md else file_digest(doc_path.old_path)
+        if (
+            cached is not None
+            and cached.hash == digest
+            and (cached.output is None or (content_dir / cached.output).exists())
+            and all((content_dir / variant).exists() for variant in cached.variants)
+        ):
+            return cached, False
+
+        # the page is written with the backlinks it had and prerender links ranked with the
+        # previous graph, update_backlinks and update_prerender fix what changed since
+        result = PathResult(digest, backlinks=cached.backlinks if cached else {})
+        if doc_path.is_md:
+            process_page(doc_path, result, cached is None)
+        else:
+            with Profiler.stage("copy"):
+                doc_path.copy()
+            with Profiler.stage("images"):
+                result.variants = doc_path.write_variants(digest)
+            result.output = str(doc_path.new_rel_path)
+            log.debug("found resource: %s", doc_path.new_rel_path)
+
+    return result, True
+
+
+def process_page(doc_path: DocPath, result: PathResult, uncached: bool = False):
+    """process markdown page with tag-based routing. pages without a cached result take
+    their backlinks from their existing output"""
+    document = doc_path.document
+    log.debug("content %d bytes for %s", document.size, doc_path.page_title)
     
-    if len(content) < 2:
-        print(f"skipping {doc_path} bc empty")
+    if document.short:
+        log.debug("skipping %s bc empty", doc_path.old_rel_path)
         return
 
-    meta_data = doc_path.frontmatter
+    with Profiler.stage("frontmatter"):
+        meta_data = doc_path.frontmatter
+    result.frontmatter = hashlib.sha1(document.raw_frontmatter.encode()).hexdigest()
     tags = meta_data.get('tags', [])
     target_section = get_target_section(tags)
 
     if not target_section:
-        print(f"skipping {doc_path.page_title} (no tag match)")
+        log.debug("skipping %s (no tag match)", doc_path.page_title)
         return
 
     templates = get_templates(target_section)
 
-    from pathlib import Path
-    doc_path.new_path = content_dir / target_section / doc_path.new_path.name
-    doc_path.new_rel_path = Path(target_section) / doc_path.new_path.name
+    doc_path.move_to(target_section)
 
-    if target_section not in seen_sections:
-        create_tag_section(target_section, templates['section'])
-        seen_sections.add(target_section)
+    result.sections[target_section] = templates['section']
+    result.url = doc_path.abs_url
+    result.title = doc_path.old_path.stem
+    result.output = str(doc_path.new_rel_path)
+    if uncached:
+        result.backlinks = written_backlinks(doc_path.new_path)
 
     if meta_data.get('graph', True):
-        nodes[doc_path.abs_url] = doc_path.page_title
+        result.nodes[doc_path.abs_url] = doc_path.page_title
 
-    print(f"found metadata for {doc_path.abs_url}: {meta_data}")
-    print(f"  -> routing to: {doc_path.new_rel_path}")
+    log.debug("found metadata for %s: %s", doc_path.abs_url, meta_data)
+    log.debug("  -> routing to: %s", doc_path.new_rel_path)
 
-    parsed_lines: List[str] = []
-    links = []
-    
-    for line in content:
-        parsed_line, linked = DocLink.parse(line, doc_path)
-        links += linked
-        parsed_line = re.sub(r"\\\\\s*$", r"\\\\\\\\", parsed_line)
-        parsed_lines.append(parsed_line)
-        
-        if meta_data.get('graph', True):
-            edges.extend([doc_path.edge(rel_path) for rel_path in linked])
+    with Profiler.stage("links"):
+        if document.streamed:
+            body, links = DocLink.parse_batches(document.batches(), doc_path)
+        else:
+            body, links = DocLink.parse_lines(document.lines, doc_path)
+
+    if meta_data.get('graph', True):
+        result.edges = sorted({doc_path.edge(rel_path) for rel_path in links})
+
+    result.links = links
+    result.bad_links = links.count("/404")
+    result.prerender = rank_links(
+        doc_path.abs_url, links, page_degrees, int(Settings.options["PRERENDER_LIMIT"] or 0)
+    )
+
+    if Settings.is_true("SEARCH_INDEX"):
+        with Profiler.stage("search"):
+            result.terms, result.summary = index_page(doc_path.page_title, tags, map("".join, document.batches()))
     
-    date_created = normalize_date(meta_data.get('created', doc_path.modified))
-    date_modified = normalize_date(meta_data.get('modified', doc_path.modified))
+    modified = doc_path.modified
+    date_created = normalize_date(meta_data.get('created', modified))
+    date_modified = normalize_date(meta_data.get('modified', modified))
     extras = metadata_handlers.get_frontmatter_extras(meta_data)
 
     frontmatter = [
@@ -154,9 +818,11 @@ def process_page(
         f"updated: {date_modified}",
         f"template: {templates['page']}",
         "extra:",
-        f"    prerender: {links}",
     ]
     for key, value in extras.items():
+        if f"    {key}: " in TRAILING_KEYS:
+            log.warning("%s: frontmatter key %s is the converter's own, left out", doc_path.old_rel_path, key)
+            continue
         if isinstance(value, list):
             frontmatter.append(f'    {key}: [')
             for item in value:
@@ -165,15 +831,18 @@ def process_page(
         else:
             frontmatter.append(f'    {key}: "{value}"')
 
-    frontmatter.extend(["---", ""])
-    
-    doc_path.write([
-        "\n".join(frontmatter),
-        convert_metadata_to_html(meta_data),
-        *parsed_lines
+    frontmatter.extend([
+        prerender_line(result.prerender), backlinks_line(result.backlinks), "---", "",
     ])
     
-    print(f"found page: {doc_path.new_rel_path}")
+    with Profiler.stage("write"):
+        head = ["\n".join(frontmatter), convert_metadata_to_html(meta_data)]
+        if document.streamed:
+            doc_path.write_stream(chain(head, body))
+        else:
+            doc_path.write(head + [body])
+    
+    log.debug("found page: %s", doc_path.new_rel_path)
 
 
 def create_tag_section(section_name: str, template: str):
@@ -192,11 +861,9 @@ def create_tag_section(section_name: str, template: str):
         "",
     ]
     
-    index_path = section_path / "_index.md"
-    with open(index_path, "w") as f:
-        f.write("\n".join(frontmatter))
+    write_text(section_path / "_index.md", "\n".join(frontmatter))
     
-    print(f"created tag section: {section_name}")
+    log.debug("created tag section: %s", section_name)
 
 def normalize_date(date_val):
     """ensure date has seconds + timezone for zola"""
@@ -13,119 +13,168 @@ if (curr_url.endsWith("/")) {
     curr_url = curr_url.slice(0, -1);
 }
 
+// Path of current page relative to the site root, as in node urls
+var root_path = new URL(graph_root || "/", location.href).pathname.replace(/\/$/, "");
+var page_path = curr_url.startsWith(root_path) ? curr_url.slice(root_path.length) : curr_url;
+
 // Get graph element
 var container = document.getElementById("graph");
 
-// Parse nodes and edges
-try {
-    var curr_node = graph_data.nodes.filter(
-        (node) => curr_url.toLowerCase().endsWith(decodeURI(node.url).toLowerCase())
-    );
-} catch (error) {
-    var curr_node = null;
-}
-var nodes = null;
-var edges = new vis.DataSet(graph_data.edges);
-
-if (curr_node.length > 0) {
-    curr_node = curr_node[0];
-
-    // Get nodes connected to current
-    var connected_nodes = graph_data.edges
-        .filter((edge) => edge.from == curr_node.id || edge.to == curr_node.id)
-        .map((edge) => {
-            if (edge.from == curr_node.id) {
-                return edge.to;
-            }
-            return edge.from;
+// Expand a compact graph shard (GRAPH_SHARDS) into vis.js nodes and edges,
+// indexing neighbourhood shards that come without lookup tables
+function expandGraph(shard) {
+    var edges = [];
+    var adjacency = {};
+    for (var i = 0; i < shard.edges.length; i += 2) {
+        var from = shard.edges[i];
+        var to = shard.edges[i + 1];
+        edges.push({ from: from, to: to });
+        (adjacency[from] = adjacency[from] || []).push(to);
+        if (from != to) (adjacency[to] = adjacency[to] || []).push(from);
+    }
+    var index = shard.index;
+    if (!index) {
+        index = {};
+        shard.nodes.forEach(([id, label, url]) => {
+            index[decodeURI(url).toLowerCase()] = id;
         });
+    }
+    return {
+        index: index,
+        adjacency: adjacency,
+        nodes: shard.nodes.map(([id, label, url, style, value, x, y]) => ({
+            id: id,
+            label: label,
+            url: url,
+            root_url: graph_root + url,
+            value: value,
+            x: x,
+            y: y,
+            ...graph_styles[style],
+        })),
+        edges: edges,
+    };
+}
 
+// Fetch only the current page's neighbourhood for local graphs, else the whole graph
+function fetchGraph() {
+    var global_url = encodeURI(root_path + "/graph.json");
+    var shard_url = global_url;
     if (graph_is_local) {
-        nodes = new vis.DataSet(
-            graph_data.nodes.filter(
-                (node) =>
-                    node.id == curr_node.id || connected_nodes.includes(node.id)
-            )
-        );
-    } else {
-        nodes = new vis.DataSet(graph_data.nodes);
+        shard_url = encodeURI(root_path + "/graph" + page_path + ".json");
     }
-} else {
-    curr_node = null;
-    nodes = new vis.DataSet(graph_data.nodes);
+    return fetch(shard_url)
+        .then((response) => (response.ok ? response : fetch(global_url)))
+        .then((response) => response.json())
+        .then(expandGraph);
 }
 
-// Get nodes and edges from generated javascript
-var max_node_val = Math.max(...nodes.map((node) => node.value));
-
-// Highlight current node and set to center
-console.log(curr_node);
-console.log("-")
-console.log(nodes);
-if (curr_node) {
-    nodes.update({
-        id: curr_node.id,
-        value: Math.max(4, max_node_val * 2.5),
-        shape: "box",
-        color: {
-            background: "#08bdba",  // ox-cyan for current node
-            border: "#161616"
-        },
-        font: {
-            color: "#ffffff",  // White text on cyan background
-            strokeWidth: 0,
-        },
-        shapeProperties: {
-            borderRadius: 2
-        },
-        x: 0,
-        y: 0,
-    });
+// Node ids are array positions, except in neighbourhood shards
+function nodeById(graph_data, id) {
+    var node = graph_data.nodes[id];
+    return node && node.id == id ? node : graph_data.nodes.find((node) => node.id == id);
 }
 
-// Construct graph
-var options = ___GRAPH_OPTIONS___;
+function drawGraph(graph_data) {
+    // Find current node and its neighbours through the lookup tables from parse_graph
+    var curr_id = graph_data.index[page_path.toLowerCase()];
+    var curr_node = curr_id === undefined ? null : nodeById(graph_data, curr_id);
+    var nodes = null;
+    var edges = new vis.DataSet(graph_data.edges);
 
-var graph = new vis.Network(
-    container,
-    {
-        nodes: nodes,
-        edges: edges,
-    },
-    options
-);
-
-// Clickable URL
-graph.on("selectNode", function (params) {
-    if (params.nodes.length === 1) {
-        var node = nodes.get(params.nodes[0]);
-        var mode = ""
-        if (graph_link_replace) {
-            mode = "_self"
-        } else {
-            mode ="_blank";
-        }
-        window.open(node.root_url, mode);
+    if (curr_node && graph_is_local) {
+        nodes = new vis.DataSet(
+            [...new Set([curr_node.id, ...(graph_data.adjacency[curr_node.id] || [])])]
+                .sort((a, b) => a - b)
+                .map((id) => nodeById(graph_data, id))
+        );
+    } else {
+        nodes = new vis.DataSet(graph_data.nodes);
     }
-});
 
-// Focus on current node + scaling
-graph.once("afterDrawing", function () {
+    // Get nodes and edges from generated javascript
+    var max_node_val = Math.max(...nodes.map((node) => node.value));
+
+    // Highlight current node and set to center
+    console.log(curr_node);
+    console.log("-")
+    console.log(nodes);
     if (curr_node) {
-        if (!graph_is_local) {
-            graph.focus(curr_node.id, {
-                scale: 0.8,
-                locked: true,
-            });
-        }
-    } else {
-        var clientHeight = container.clientHeight;
-        graph.moveTo({
-            position: {
-                x: 0,
-                y: -clientHeight / 2,
+        nodes.update({
+            id: curr_node.id,
+            value: Math.max(4, max_node_val * 2.5),
+            shape: "box",
+            color: {
+                background: "#08bdba",  // ox-cyan for current node
+                border: "#161616"
+            },
+            font: {
+                color: "#ffffff",  // White text on cyan background
+                strokeWidth: 0,
             },
-            scale: graph.getScale() * 0.9,
+            shapeProperties: {
+                borderRadius: 2
+            },
+            // nodes keep their build time positions (GRAPH_LAYOUT)
+            ...(graph_layout ? {} : { x: 0, y: 0 }),
         });
     }
-});
+
+    // Construct graph
+    var options = ___GRAPH_OPTIONS___;
+
+    // Positions were computed at build time, skip the force simulation
+    if (graph_layout) {
+        options.physics = false;
+    }
+
+    var graph = new vis.Network(
+        container,
+        {
+            nodes: nodes,
+            edges: edges,
+        },
+        options
+    );
+
+    // Clickable URL
+    graph.on("selectNode", function (params) {
+        if (params.nodes.length === 1) {
+            var node = nodes.get(params.nodes[0]);
+            var mode = ""
+            if (graph_link_replace) {
+                mode = "_self"
+            } else {
+                mode ="_blank";
+            }
+            window.open(node.root_url, mode);
+        }
+    });
+
+    // Focus on current node + scaling
+    graph.once("afterDrawing", function () {
+        if (curr_node) {
+            if (!graph_is_local) {
+                graph.focus(curr_node.id, {
+                    scale: 0.8,
+                    locked: true,
+                });
+            }
+        } else {
+            var clientHeight = container.clientHeight;
+            graph.moveTo({
+                position: {
+                    x: 0,
+                    y: -clientHeight / 2,
+                },
+                scale: graph.getScale() * 0.9,
+            });
+        }
+    });
+}
+
+if (graph_data) {
+    drawGraph(graph_data);
+} else {
+    fetchGraph().then(drawGraph);
+}
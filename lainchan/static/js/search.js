@@ -68,12 +68,15 @@ Source:
   - https://github.com/getzola/zola/blob/master/docs/static/search.js
 */
 (function(){
-  let index = elasticlunr.Index.load(window.searchIndex);
+  const search = window.searchIndex ? lunrSearch() : shardSearch();
+  const stemmer = window.searchIndex ? elasticlunr.stemmer : function (w) { return w; };
+  let latest = 0;
   userinput.addEventListener('input', show_results, true);
   suggestions.addEventListener('click', accept_suggestion, true);
-  
-  function show_results(){
-    const value = this.value.trim();
+
+  // zola's elasticlunr index, loaded whole from search_index.<lang>.js
+  function lunrSearch(){
+    const index = elasticlunr.Index.load(window.searchIndex);
     const options = {
       bool: "OR",
       fields: {
@@ -82,7 +85,66 @@ Source:
         expand: true
       }
     };
-    const results = index.search(value, options);
+    return function (value) {
+      return Promise.resolve(index.search(value, options).map(function (page) {
+        return {url: page.ref, title: page.doc.title, body: page.doc.body};
+      }));
+    };
+  }
+
+  // the index convert.py writes with SEARCH_INDEX, fetched a prefix shard at a time
+  function shardSearch(){
+    const base = document.querySelector('script[src*="js/search.js"]').src.replace(/js\/search\.js.*$/, 'search/');
+    const cache = {};
+    const fetchJSON = function (path) {
+      if (!(path in cache)) {
+        cache[path] = fetch(base + path).then(function (r) { return r.ok ? r.json() : {}; });
+      }
+      return cache[path];
+    };
+    const hex = function (s) {
+      return Array.from(new TextEncoder().encode(s), function (b) { return b.toString(16).padStart(2, '0'); }).join('');
+    };
+
+    return async function (value) {
+      const meta = await fetchJSON('meta.json');
+      // same words as search_terms in utils.py
+      const words = value.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+      const shards = await Promise.all(words.map(function (w) {
+        return fetchJSON(hex(Array.from(w).slice(0, meta.prefix).join('')) + '.json');
+      }));
+
+      // words match terms they prefix, weighted by rarity, exact matches count double
+      const scores = new Map();
+      words.forEach(function (w, n) {
+        for (const term in shards[n]) {
+          if (!term.startsWith(w)) continue;
+          const postings = shards[n][term];
+          const idf = Math.log(1 + meta.docs / (postings.length / 2)) * (term === w ? 2 : 1);
+          for (let i = 0; i < postings.length; i += 2) {
+            scores.set(postings[i], (scores.get(postings[i]) || 0) + postings[i + 1] * idf);
+          }
+        }
+      });
+      const top = Array.from(scores.keys()).sort(function (a, b) { return scores.get(b) - scores.get(a); }).slice(0, 10);
+
+      const docs = await Promise.all(top.map(function (id) {
+        return fetchJSON('docs/' + Math.floor(id / meta.per_shard) + '.json');
+      }));
+      return top.map(function (id, n) {
+        const [url, title, summary] = docs[n][id % meta.per_shard];
+        return {url: meta.root + url, title: title, body: summary || title};
+      });
+    };
+  }
+
+  async function show_results(){
+    const value = this.value.trim();
+    const query = ++latest;
+    const results = await search(value);
+    if (query !== latest) {
+      return;
+    }
 
     let entry;
     const childs = suggestions.childNodes;
@@ -91,7 +153,7 @@ Source:
     suggestions.classList.remove('d-none');
 
     results.forEach(function(page) {
-      if (page.doc.body !== '') {
+      if (page.body !== '') {
         entry = document.createElement('div');
 
         entry.innerHTML = '<a href><span></span><span></span></a>';
@@ -99,9 +161,9 @@ Source:
         a = entry.querySelector('a'),
         t = entry.querySelector('span:first-child'),
         d = entry.querySelector('span:nth-child(2)');
-        a.href = page.ref;
-        t.textContent = page.doc.title;
-        d.innerHTML = makeTeaser(page.doc.body, items);
+        a.href = page.url;
+        t.textContent = page.title;
+        d.innerHTML = makeTeaser(page.body, items);
   
         suggestions.appendChild(entry);
       }
@@ -147,7 +209,7 @@ Source:
 
 
     const stemmedTerms = terms.map(function (w) {
-      return elasticlunr.stemmer(w.toLowerCase());
+      return stemmer(w.toLowerCase());
     });
     let termFound = false;
     let index = 0;
@@ -164,7 +226,7 @@ Source:
   
         if (word.length > 0) {
           for (let k in stemmedTerms) {
-            if (elasticlunr.stemmer(word).startsWith(stemmedTerms[k])) {
+            if (stemmer(word).startsWith(stemmedTerms[k])) {
               value = TERM_WEIGHT;
               termFound = true;
             }
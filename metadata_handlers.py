@@ -5,6 +5,10 @@ tags handled separately bc routing logic, everything else just goes through.
 
 SKIP_FIELDS = {'created', 'modified', 'title'}  # handled elsewhere
 
+# more handlers by frontmatter key (any case) for ones that can't be plain functions here,
+# e.g. HANDLERS["date-published"] = lambda value: f"<time>{value}</time>"
+HANDLERS = {}
+
 def get_frontmatter_extras(metadata: dict) -> dict:
     return {
         key.replace('-', '_'): str(value).strip() if not isinstance(value, list) else value
@@ -12,8 +12,16 @@ tmux send-keys -t $SESSION:0 ". ./env.sh && excavation --root=build serve" C-m
 tmux new-window -t $SESSION:1 -n "ide"
 tmux send-keys -t $SESSION:1 "code ." C-m
 
+# convert.py --watch converts whatever obsidian-export changes, keeping its state in memory.
+# the windows after it run build.sh's steps again when the vault or the theme changes
 tmux new-window -t $SESSION:2 -n "watch"
-tmux send-keys -t $SESSION:2 ". ./env.sh && find zola -type f | entr -r ./build.sh" C-m
+tmux send-keys -t $SESSION:2 '. ./env.sh && ./build.sh && . ./build.sh && "$PYTHON" convert.py --watch' C-m
+
+tmux new-window -t $SESSION:3 -n "export"
+tmux send-keys -t $SESSION:3 '. ./env.sh && find "$VAULT" -type f | entr -r bash -c ". ./build.sh && export_vault"' C-m
+
+tmux new-window -t $SESSION:4 -n "theme"
+tmux send-keys -t $SESSION:4 '. ./env.sh && find "$THEME" content -type f | entr bash -c ". ./build.sh && copy_theme && convert_vault"' C-m
 
 tmux select-window -t $SESSION:2
 
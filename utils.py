@@ -1,63 +1,116 @@
+import hashlib
+import heapq
+import io
 import json
+import logging
+import marshal
 import math
 import os
+import random
 import re
 import shutil
+import time
+from array import array
+from contextlib import contextmanager, nullcontext
 from dataclasses import dataclass
 from datetime import datetime
-from inspect import getmembers, isfunction
+from functools import lru_cache
+from itertools import islice
 from os import environ
 from pathlib import Path
-from pprint import PrettyPrinter
-from typing import Dict, List, Optional, Tuple, Union
+from stat import S_ISREG
+from collections import Counter
+from types import FunctionType
+from typing import Any, Callable, ClassVar, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
 from urllib.parse import quote, unquote
 
-from slugify import slugify
-import yaml
-
 import metadata_handlers
 
-site_dir = Path(__file__).parent.absolute() / "build"
+site_dir = Path(environ.get("BUILD_DIR", Path(__file__).parent / "build")).absolute()
 raw_dir = site_dir / "__vault_export"
 content_dir = site_dir / "content"
 
+log = logging.getLogger("obsidian-zola")
+
+def setup_logging(level: int):
+    """prints this logger's records as bare messages from level up. the root logger is left
+    alone, so -v doesn't turn on the debug output of libraries like Pillow"""
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+    log.setLevel(level)
+    log.propagate = False
+
 # ---------------------------------------------------------------------------- #
 #                                 General Utils                                #
 # ---------------------------------------------------------------------------- #
 
-def to_prerender_links(links: List[str]) -> str:
-    """converts links to prerender links"""
-    x = ''.join([f'<link rel="prerender" href="{link}" as="document"/>\n' for link in links])
-    print(x)
-    return x
-
-pp = PrettyPrinter(indent=4, compact=False).pprint
-
 def convert_metadata_to_html(metadata: dict) -> str:
     """convert yaml metadata to HTML depending on metadata type"""
     parsed_metadata = ""
     handlers = get_metadata_handlers()
 
-    for metadata_key in metadata:
-        if metadata_key.lower() in [name for name, _ in handlers]:
-            func = [func for name, func in handlers if name.lower() == metadata_key.lower()][0]
-            parsed_metadata += str(func(metadata[metadata_key])).strip().replace("\n", " ") + "\n"
+    for metadata_key, value in metadata.items():
+        func = handlers.get(str(metadata_key).lower())
+        if func is not None:
+            parsed_metadata += str(func(value)).strip().replace("\n", " ") + "\n"
     return parsed_metadata
 
-def get_metadata_handlers():
-    return [(name, func) for name, func in getmembers(metadata_handlers, isfunction) if not name.startswith("_")]
+@lru_cache(maxsize=None)
+def get_metadata_handlers() -> Dict[str, Callable[[Any], Any]]:
+    """handlers by lowercase frontmatter key, collected once: the public functions of
+    metadata_handlers, then its HANDLERS, then whatever register_metadata_handler adds"""
+    handlers = {
+        name.lower(): func for name, func in vars(metadata_handlers).items()
+        if isinstance(func, FunctionType) and not name.startswith("_")
+    }
+    handlers.update((key.lower(), func) for key, func in metadata_handlers.HANDLERS.items())
+    return handlers
+
+# handlers register_metadata_handler added, by lowercase key. pool workers are given them
+# in convert.init_worker, and handler_versions puts them in the build version
+registered_handlers: Dict[str, Callable[[Any], Any]] = {}
+
+def register_metadata_handler(key: str, handler: Optional[Callable[[Any], Any]] = None):
+    """renders frontmatter key, in any case, with handler. returns a decorator when handler
+    is left out. register before convert.main: handlers are pickled for pool workers, so
+    they have to be module level functions, and adding or changing one converts every
+    page again"""
+    def register(handler: Callable[[Any], Any]) -> Callable[[Any], Any]:
+        get_metadata_handlers()[key.lower()] = handler
+        registered_handlers[key.lower()] = handler
+        return handler
+    return register if handler is None else register(handler)
+
+def handler_versions() -> str:
+    """names and bytecode hashes of the registered handlers, changes with any of them"""
+    versions = []
+    for key, handler in sorted(registered_handlers.items()):
+        code = getattr(handler, "__code__", None)
+        name = getattr(handler, "__qualname__", type(handler).__qualname__)
+        digest = hashlib.sha1(marshal.dumps(code)).hexdigest() if code is not None else ""
+        versions.append(f"{key}={getattr(handler, '__module__', '')}.{name}:{digest}")
+    return "\n".join(versions)
+
+@lru_cache(maxsize=1 << 16)
+def slugify_component(item: str, lowercase: bool) -> str:
+    """slugifies one path component, most components repeat across a vault"""
+    from slugify import slugify
+
+    return slugify(item, lowercase=lowercase)
 
 def slugify_path(path: Union[str, Path], no_suffix: bool, lowercase=False) -> Path:
     """slugifies every component of a path. no_suffix=True when path is URL or directory"""
     path = Path(str(path))
     if Settings.is_true("SLUGIFY"):
         if no_suffix:
-            os_path = "/".join(slugify(item, lowercase=lowercase) for item in path.parts)
+            os_path = "/".join(slugify_component(item, lowercase) for item in path.parts)
             name = ""
             suffix = ""
         else:
-            os_path = "/".join(slugify(item, lowercase=lowercase) for item in str(path.parent).split("/"))
-            name = ".".join(slugify(item, lowercase=lowercase) for item in path.stem.split("."))
+            os_path = "/".join(slugify_component(item, lowercase) for item in str(path.parent).split("/"))
+            name = ".".join(slugify_component(item, lowercase) for item in path.stem.split("."))
             suffix = path.suffix
 
         if name != "" and suffix != "":
@@ -69,10 +122,301 @@ def slugify_path(path: Union[str, Path], no_suffix: bool, lowercase=False) -> Pa
     else:
         return path
 
+@lru_cache(maxsize=1 << 16)
+def resolve_url(directory: Path, url: str) -> Optional[str]:
+    """absolute URL of a quoted URL relative to directory, None if it leaves content_dir"""
+    try:
+        new_rel_path = (directory / unquote(url)).resolve().relative_to(content_dir)
+        return "/" + quote(str(slugify_path(new_rel_path, False)))
+    except Exception:
+        return None
+
+# compiled .gitignore style pattern: regex, whether it includes again, directories only
+IgnoreRule = Tuple[re.Pattern, bool, bool]
+
+def ignore_pattern(pattern: str) -> re.Pattern:
+    """regex for one .gitignore style pattern (without ! or a trailing /). patterns with
+    a / are anchored to the root, others match a name at any depth"""
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    parts = [] if anchored else ["(?:.*/)?"]
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i) and i + 2 == len(pattern):
+            parts.append(".*")
+            i += 2
+            continue
+        if char == "*":
+            parts.append("[^/]*")
+        elif char == "?":
+            parts.append("[^/]")
+        elif char == "[" and "]" in pattern[i + 2:]:
+            end = pattern.index("]", i + 2)
+            body = pattern[i + 1:end].replace("\\", "\\\\")
+            parts.append("[^" + body[1:] + "]" if body[0] == "!" else "[" + body + "]")
+            i = end
+        elif char == "\\" and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return re.compile("".join(parts) + r"\Z")
+
+@lru_cache(maxsize=None)
+def ignore_rules(patterns: str) -> Tuple[IgnoreRule, ...]:
+    """compiles .gitignore style patterns, one per line or comma separated: # comments,
+    ! includes a path again, a trailing / only matches directories. returns
+    (regex, include, directories only) per pattern"""
+    rules = []
+    for line in re.split(r"[,\n]", patterns):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        include = line.startswith("!")
+        line = line.lstrip("!")
+        only_dirs = line.endswith("/")
+        line = line.rstrip("/")
+        if line:
+            rules.append((ignore_pattern(line), include, only_dirs))
+    return tuple(rules)
+
+def is_ignored(rel_path: str, is_dir: bool, rules: Iterable[IgnoreRule]) -> bool:
+    """whether the last rule matching a /-separated relative path excludes it. like git,
+    callers don't look inside ignored directories"""
+    ignored = False
+    for pattern, include, only_dirs in rules:
+        if (is_dir or not only_dirs) and pattern.match(rel_path):
+            ignored = not include
+    return ignored
+
+def scan_tree(
+    root: Path, rules: Iterable[IgnoreRule] = (), prefix: str = ""
+) -> Iterator[Tuple[Path, os.stat_result]]:
+    """every path under root with its stat, from one os.scandir walk in the order of
+    sorted(root.glob("**/*")): each directory right before its contents, symlinked
+    directories not entered. paths the ignore rules match, prefix + their path relative
+    to root, are skipped along with everything under them. yields while it walks"""
+    try:
+        with os.scandir(root) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        is_dir = entry.is_dir(follow_symlinks=False)
+        rel_path = prefix + entry.name
+        if rules and is_ignored(rel_path, is_dir, rules):
+            log.debug("ignored: %s", rel_path)
+            continue
+        try:
+            info = entry.stat()
+        except FileNotFoundError:
+            continue
+        path = Path(entry.path)
+        yield path, info
+        if is_dir:
+            yield from scan_tree(path, rules, rel_path + "/")
+
+@lru_cache(maxsize=None)
+def image_widths(value: str) -> Tuple[int, ...]:
+    """the sorted widths of an IMAGE_WIDTHS setting such as 480, 960, 1600"""
+    return tuple(sorted({int(width) for width in re.split(r"[,\s]+", value) if width}))
+
+def variant_name(base: str, width: int) -> str:
+    """path or url of an image's variant from the image's without its suffix"""
+    return f"{base}.{width}w.{Settings.options['IMAGE_FORMAT']}"
+
+def encode_variants(src: Path, digest: str, widths: Iterable[int]) -> List[Path]:
+    """src scaled down to each width (never up) in IMAGE_FORMAT. encoded files are kept
+    in site_dir/IMAGE_CACHE by content hash and width, so an image is opened and
+    encoded once however often it is renamed, copied or converted again. needs Pillow"""
+    fmt = Settings.options["IMAGE_FORMAT"]
+    paths = [site_dir / IMAGE_CACHE / f"{digest}-{width}.{fmt}" for width in widths]
+    missing = [(width, path) for width, path in zip(widths, paths) if not path.exists()]
+    if not missing:
+        return paths
+
+    from PIL import Image, ImageOps
+
+    paths[0].parent.mkdir(parents=True, exist_ok=True)
+    with Image.open(src) as original:
+        # phone photos are stored sideways with an exif orientation
+        image = ImageOps.exif_transpose(original)
+        if fmt.lower() in ("jpg", "jpeg") and image.mode != "RGB":
+            image = image.convert("RGB")
+        elif image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        for width, path in sorted(missing, reverse=True):
+            if image.width > width:
+                image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+            # pool workers may encode the same image, each renames its own file
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            image.save(tmp, format=Image.registered_extensions()[f".{fmt}"], quality=IMAGE_QUALITY)
+            os.replace(tmp, path)
+    return paths
+
+def prune_image_cache(digests: Iterable[str]):
+    """deletes encoded variants of images no longer in the export"""
+    keep = set(digests)
+    try:
+        entries = list(os.scandir(site_dir / IMAGE_CACHE))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.name.split("-", 1)[0] not in keep:
+            os.unlink(entry.path)
+
+def cache_stats() -> Dict[str, Tuple[int, int]]:
+    """hits and misses of the url and slug caches"""
+    return {
+        name: (func.cache_info().hits, func.cache_info().misses)
+        for name, func in (("url", resolve_url), ("slug", slugify_component))
+    }
+
+# ---------------------------------------------------------------------------- #
+#                                    Output                                    #
+# ---------------------------------------------------------------------------- #
+
+# (avoided, done) pairs: page writes skipped because the file already held the same
+# text, resources linked or already in place instead of copied, and bytes not written
+output_counts: Dict[str, List[int]] = {"writes": [0, 0], "resources": [0, 0], "bytes": [0, 0]}
+
+# linux ioctl cloning a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def output_stats() -> Dict[str, Tuple[int, int]]:
+    return {name: (avoided, done) for name, (avoided, done) in output_counts.items()}
+
+def write_text(path: Path, content: str) -> bool:
+    """writes content unless path already holds it, keeping the old mtime for zola.
+    returns whether it wrote"""
+    data = content.encode("utf-8")
+    try:
+        if path.stat().st_size == len(data) and path.read_bytes() == data:
+            output_counts["writes"][0] += 1
+            output_counts["bytes"][0] += len(data)
+            return False
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    output_counts["writes"][1] += 1
+    output_counts["bytes"][1] += len(data)
+    return True
+
+def write_stream(path: Path, parts: Iterable[str]) -> bool:
+    """write_text for content too large to join in memory. parts go to a temporary file
+    next to path, which replaces it unless path already holds the same bytes"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    try:
+        with open(tmp, "w", encoding="utf-8", newline="") as f:
+            for part in parts:
+                f.write(part)
+        size = tmp.stat().st_size
+        try:
+            unchanged = path.stat().st_size == size and same_content(tmp, path)
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged:
+            tmp.unlink()
+        else:
+            os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    written = 0 if unchanged else 1
+    output_counts["writes"][written] += 1
+    output_counts["bytes"][written] += size
+    return not unchanged
+
+def same_content(a: Path, b: Path, chunk_size: int = 1 << 20) -> bool:
+    """compares two files of equal size in chunks, never loading either whole"""
+    with open(a, "rb") as fa, open(b, "rb") as fb:
+        while True:
+            chunk = fa.read(chunk_size)
+            if chunk != fb.read(chunk_size):
+                return False
+            if not chunk:
+                return True
+
+def place_file(src: Path, dst: Path, link: bool = True) -> str:
+    """puts a copy of src at dst unless dst already matches it (same file, same size and
+    mtime, or same bytes). tries a hardlink, then a reflink, then copies with metadata,
+    so size and mtime match next time. returns what it did"""
+    src_stat = src.stat()
+    try:
+        dst_stat = dst.stat()
+    except FileNotFoundError:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+    else:
+        if dst_stat.st_size == src_stat.st_size and (
+            os.path.samestat(src_stat, dst_stat)
+            or dst_stat.st_mtime_ns == src_stat.st_mtime_ns
+            or same_content(src, dst)
+        ):
+            output_counts["resources"][0] += 1
+            output_counts["bytes"][0] += src_stat.st_size
+            return "unchanged"
+        dst.unlink()
+
+    method = "copied"
+    if link:
+        try:
+            os.link(src, dst)
+            method = "linked"
+        except OSError:
+            method = "reflinked" if reflink(src, dst) else "copied"
+    if method == "copied":
+        shutil.copy2(src, dst)
+        output_counts["resources"][1] += 1
+        output_counts["bytes"][1] += src_stat.st_size
+    else:
+        output_counts["resources"][0] += 1
+        output_counts["bytes"][0] += src_stat.st_size
+    return method
+
+def reflink(src: Path, dst: Path) -> bool:
+    """copy-on-write clone of src at dst with src's times, false where unsupported"""
+    try:
+        import fcntl
+
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (ImportError, OSError):
+        dst.unlink(missing_ok=True)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
 # ---------------------------------------------------------------------------- #
 #                               Document Classes                               #
 # ---------------------------------------------------------------------------- #
 
+# [title](url<.md?><#header?>) with title, url, md and header captured
+LINK_PATTERN = re.compile(r"\[((.*?)\]\((?!http)(\S*?)(\.md)?(#\S+)?)\)")
+INNER_LINK_PATTERN = re.compile(r"\[.*?\]\(\S*?\)")
+# "\\" at the end of a line is a hard line break, doubled for zola
+LINE_BREAK_PATTERN = re.compile(r"\\\\\s*$")
+
+# notes larger than this are converted STREAM_BATCH lines at a time instead of read whole.
+# none of the patterns span lines, so batches of whole lines convert the same
+STREAM_THRESHOLD = 8 << 20
+STREAM_BATCH = 4096
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".bmp")
+# images IMAGE_WIDTHS variants are made of, not vector or animated ones
+RESPONSIVE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp")
+# encoded variants by content hash and width, under site_dir
+IMAGE_CACHE = ".image-cache"
+IMAGE_QUALITY = 80
+VIDEO_EXTENSIONS = (".webm", ".mp4")
+
+
 @dataclass
 class DocLink:
     """internal links inside markdown [xxxx](yyyy<.md?>#zzzz)"""
@@ -82,13 +426,15 @@ class DocLink:
     md: str
     header: str
 
+    # urls of images without IMAGE_WIDTHS variants, rendered without a srcset. the ones
+    # the previous build found, until convert.update knows better
+    plain_images: ClassVar[Set[str]] = set()
+
     @classmethod
     def get_links(cls, line: str) -> List["DocLink"]:
         return [
             cls(f"[{combined})", title, url, md, header)
-            for combined, title, url, md, header in re.findall(
-                r"\[((.*?)\]\((?!http)(\S*?)(\.md)?(#\S+)?)\)", line
-            )
+            for combined, title, url, md, header in LINK_PATTERN.findall(line)
             if cls.no_inner_link(combined)
         ]
 
@@ -98,77 +444,249 @@ class DocLink:
 
     @staticmethod
     def no_inner_link(item: str) -> bool:
-        return re.match(r"\[.*?\]\(\S*?\)", item) is None
+        return INNER_LINK_PATTERN.match(item) is None
 
     def abs_url(self, doc_path: "DocPath") -> str:
         """returns absolute URL based on quoted relative URL from obsidian-export"""
         if self.url is None or self.url == "":
-            print(f"empty link found: {doc_path.old_rel_path}")
+            log.debug("empty link found: %s", doc_path.old_rel_path)
             return "/404"
 
-        try:
-            new_rel_path = (
-                (doc_path.new_path.parent / unquote(self.url))
-                .resolve()
-                .relative_to(content_dir)
-            )
-            new_rel_path = quote(str(slugify_path(new_rel_path, False)))
-            return f"/{new_rel_path}"
-        except Exception:
-            print(f"invalid link found: {doc_path.old_rel_path}")
+        abs_url = resolve_url(doc_path.new_path.parent, self.url)
+        if abs_url is None:
+            log.debug("invalid link found: %s", doc_path.old_rel_path)
             return "/404"
+        return abs_url
 
-    @classmethod
-    def parse(cls, line: str, doc_path: "DocPath") -> Tuple[str, List[str]]:
-        """parses and fixes all internal links in a line"""
-        parsed = line
-        linked: List[str] = []
+    def render(self, doc_path: "DocPath") -> Tuple[str, str]:
+        """returns absolute URL and the markup replacing the link"""
+        abs_url = self.abs_url(doc_path)
 
-        def decide_internal_link_format(link: "DocLink") -> Tuple[str, str]:
-            abs_url = link.abs_url(doc_path)
+        if self.title.endswith(VIDEO_EXTENSIONS):
+            return abs_url, r"{{ " + f'video(url="{abs_url}", alt="{self.title}")' + r" }}"
 
-            if any(link.title.endswith(ext) for ext in (".webm", ".mp4")):
-                return abs_url, r"{{ " + f'video(url="{abs_url}", alt="{link.title}")' + r" }}"
-            
-            if any(link.url.lower().endswith(ext) for ext in (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".bmp")):
-                return abs_url, f"![{link.title}]({abs_url})"
+        if self.url.lower().endswith(IMAGE_EXTENSIONS):
+            widths = image_widths(Settings.options["IMAGE_WIDTHS"])
+            if (
+                widths and abs_url != "/404" and abs_url not in self.plain_images
+                and self.url.lower().endswith(RESPONSIVE_EXTENSIONS)
+            ):
+                base = abs_url[:abs_url.rindex(".")]
+                srcset = ", ".join(f"{variant_name(base, width)} {width}w" for width in widths)
+                return abs_url, r"{{ " + f'image(url="{abs_url}", alt="{self.title}", srcset="{srcset}")' + r" }}"
+            return abs_url, f"![{self.title}]({abs_url})"
 
-            return abs_url, r"{{ " + f'abs_url(abs="{abs_url}{link.header}", text="{link.title}")' + r" }}"
+        return abs_url, r"{{ " + f'abs_url(abs="{abs_url}{self.header}", text="{self.title}")' + r" }}"
+
+    @classmethod
+    def parse(
+        cls, line: str, doc_path: "DocPath", rendered: Optional[Dict[str, Tuple[str, str]]] = None
+    ) -> Tuple[str, List[str]]:
+        """parses and fixes all internal links in a line. rendered keeps each link's render
+        by its text, so a link repeated on a page is rendered once"""
+        parsed = line
+        linked: List[str] = []
 
         for link in cls.get_links(line):
-            abs_url, replace_with = decide_internal_link_format(link)
+            if rendered is None:
+                abs_url, replace_with = link.render(doc_path)
+            else:
+                if link.combined not in rendered:
+                    rendered[link.combined] = link.render(doc_path)
+                abs_url, replace_with = rendered[link.combined]
             parsed = parsed.replace(link.combined, replace_with)
             linked.append(abs_url)
 
         return parsed, linked
 
+    @classmethod
+    def parse_lines(
+        cls, lines: List[str], doc_path: "DocPath", rendered: Optional[Dict[str, Tuple[str, str]]] = None
+    ) -> Tuple[str, List[str]]:
+        """parses links and line breaks of a page body, rendering each distinct link once"""
+        rendered = {} if rendered is None else rendered
+        parsed_lines: List[str] = []
+        linked: List[str] = []
+        for line in lines:
+            parsed_line, line_linked = cls.parse(line, doc_path, rendered)
+            parsed_lines.append(LINE_BREAK_PATTERN.sub(r"\\\\\\\\", parsed_line))
+            linked += line_linked
+        return "".join(parsed_lines), linked
+
+    @classmethod
+    def parse_batches(cls, batches: Iterable[List[str]], doc_path: "DocPath") -> Tuple[Iterator[str], List[str]]:
+        """parse_lines for a body too large to hold, one batch of lines at a time. the parsed
+        body is spooled to a temporary file as the links are needed first, and comes back
+        as an iterator of chunks that closes it"""
+        import tempfile
+
+        spool = tempfile.TemporaryFile("w+", encoding="utf-8", newline="", dir=site_dir)
+        linked: List[str] = []
+        rendered: Dict[str, Tuple[str, str]] = {}
+        for batch in batches:
+            body, batch_linked = cls.parse_lines(batch, doc_path, rendered)
+            spool.write(body)
+            linked += batch_linked
+        spool.seek(0)
+
+        def chunks() -> Iterator[str]:
+            with spool:
+                yield from iter(lambda: spool.read(1 << 20), "")
+
+        return chunks(), linked
+
+
+def load_yaml(text: str) -> Any:
+    """safe yaml, through libyaml's CSafeLoader when pyyaml was built with it"""
+    import yaml
+
+    return yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+# turns raw frontmatter text into a dict, see set_frontmatter_parser
+frontmatter_parser: Callable[[str], Any] = load_yaml
+
+def set_frontmatter_parser(parser: Callable[[str], Any]):
+    """parses every frontmatter with parser from now on"""
+    global frontmatter_parser
+    frontmatter_parser = parser
+    parse_frontmatter.cache_clear()
+
+@lru_cache(maxsize=1 << 12)
+def parse_frontmatter(raw: str) -> Dict[str, Any]:
+    """frontmatter_parser over raw frontmatter text, cached since notes made from a template
+    often share theirs. the result is shared by those notes, don't modify it"""
+    parsed = frontmatter_parser(raw) if raw else None
+    return parsed or {}
+
+
+class Document:
+    """markdown file read once, split into frontmatter and body in one scan. files over
+    STREAM_THRESHOLD are streamed instead: only the frontmatter is kept and the body is
+    read again, STREAM_BATCH lines at a time, whenever it is needed"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.mtime = stat.st_mtime
+            self.size = stat.st_size
+            self.streamed = self.size > STREAM_THRESHOLD
+            if self.streamed:
+                digest = hashlib.sha1()
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+                self.digest = digest.hexdigest()
+            else:
+                data = f.read()
+                self.digest = hashlib.sha1(data).hexdigest()
+
+        self.raw_frontmatter = ""
+        self.body_start = 0
+        if self.streamed:
+            self.lines: List[str] = []
+            with self.open() as f:
+                if f.readline().startswith("---"):
+                    for i, line in enumerate(f, 1):
+                        if line.startswith("---"):
+                            self.body_start = i + 1
+                            break
+            if self.body_start:
+                with self.open() as f:
+                    self.raw_frontmatter = "".join(islice(f, 1, self.body_start - 1))
+        else:
+            lines = io.StringIO(data.decode("utf-8"), newline=None).readlines()
+            self.lines = lines
+            if lines and lines[0].startswith("---"):
+                for i, line in enumerate(lines[1:]):
+                    if line.startswith("---"):
+                        self.raw_frontmatter = "".join(lines[1:i + 1])
+                        self.lines = lines[i + 2:]
+                        break
+        self._frontmatter: Optional[Dict[str, str]] = None
+
+    def open(self) -> io.TextIOWrapper:
+        """the file as text with the newline handling of the in-memory split"""
+        return open(self.path, "r", encoding="utf-8", newline=None)
+
+    def iter_lines(self) -> Iterator[str]:
+        """body lines, read from disk again when streamed"""
+        if not self.streamed:
+            yield from self.lines
+            return
+        with self.open() as f:
+            yield from islice(f, self.body_start, None)
+
+    def batches(self) -> Iterator[List[str]]:
+        """body lines in lists of up to STREAM_BATCH when streamed, else all in one"""
+        if not self.streamed:
+            yield self.lines
+            return
+        lines = self.iter_lines()
+        while True:
+            batch = list(islice(lines, STREAM_BATCH))
+            if not batch:
+                return
+            yield batch
+
+    @property
+    def short(self) -> bool:
+        """fewer than two body lines"""
+        return len(list(islice(self.iter_lines(), 2))) < 2
+
+    @property
+    def frontmatter(self) -> Dict[str, str]:
+        """yaml frontmatter, parsed at most once"""
+        if self._frontmatter is None:
+            self._frontmatter = parse_frontmatter(self.raw_frontmatter)
+        return self._frontmatter
+
 
 class DocPath:
-    """any path found in exported obsidian directory - section/page/resource"""
-    
-    def __init__(self, path: Path, target_section: Optional[str] = None):
-        """path parsing with optional section override"""
-        self.old_path = path.resolve()
+    """any path found in exported obsidian directory - section/page/resource. a slotted
+    record: filesystem facts come from the stat it was found with, derived strings are
+    computed once"""
+    __slots__ = (
+        "old_path", "old_rel_path", "new_rel_path", "new_path", "is_file", "is_md",
+        "_document", "_abs_url", "_page_title",
+    )
+
+    def __init__(self, path: Path, target_section: Optional[str] = None, stat: Optional[os.stat_result] = None):
+        """path parsing with optional section override. stats path unless given its stat"""
+        self.old_path = Path(os.path.abspath(path))
         self.old_rel_path = self.old_path.relative_to(raw_dir)
+        if stat is None:
+            try:
+                stat = self.old_path.stat()
+            except OSError:
+                pass
+        self.is_file = stat is not None and S_ISREG(stat.st_mode)
+        self.is_md = self.is_file and self.old_path.suffix == ".md"
+        self._document: Optional[Document] = None
+        self._abs_url: Optional[str] = None
+        self._page_title: Optional[str] = None
         new_rel_path = self.old_rel_path
 
         # handle sibling folder collision
         if self.is_md and (self.old_path.parent / self.old_path.stem).is_dir():
-            print(f"name collision with sibling folder, renaming: {self.old_rel_path}")
+            log.debug("name collision with sibling folder, renaming: %s", self.old_rel_path)
             new_rel_path = self.old_rel_path.parent / (
                 self.old_rel_path.stem + "-nested" + self.old_rel_path.suffix
             )
 
         self.new_rel_path = slugify_path(new_rel_path, not self.is_file)
-        
+        self.new_path = content_dir / str(self.new_rel_path)
+
         # apply section override if provided
         if target_section and self.is_file:
-            self.new_path = content_dir / target_section / self.new_rel_path.name
-            self.new_rel_path = Path(target_section) / self.new_rel_path.name
-        else:
-            self.new_path = content_dir / str(self.new_rel_path)
-        
-        print(f"new path: {self.new_path}")
+            self.move_to(target_section)
+
+        log.debug("new path: %s", self.new_path)
+
+    def move_to(self, section: str):
+        """routes the path into a section, keeping its file name"""
+        self.new_path = content_dir / section / self.new_path.name
+        self.new_rel_path = Path(section) / self.new_path.name
+        self._abs_url = None
 
     # --------------------------------- Sections --------------------------------- #
 
@@ -187,7 +705,7 @@ class DocPath:
         assert Settings.options["SUBSECTION_SYMBOL"] is not None
         section_symbol = Settings.options["SUBSECTION_SYMBOL"] if sidebar.count("/") > 0 else ""
         sidebar = section_symbol + sidebar.split("/")[-1]
-        print("sidebar", sidebar)
+        log.debug("sidebar %s", sidebar)
         return (
             sidebar
             if (sidebar != "" and sidebar != ".")
@@ -196,24 +714,24 @@ class DocPath:
 
     def write_to(self, child: str, content: Union[str, List[str]]):
         """writes content to a child path under new path"""
-        new_path = self.new_path / child
-        new_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(new_path, "w") as f:
-            if isinstance(content, str):
-                f.write(content)
-            else:
-                f.write("\n".join(content))
+        if not isinstance(content, str):
+            content = "\n".join(content)
+        write_text(self.new_path / child, content)
 
     # ----------------------------------- Pages ---------------------------------- #
 
     @property
     def page_title(self) -> str:
-        title = " ".join([item for item in self.old_path.stem.split(" ")]).replace('"', r"\"")
-        return title
+        if self._page_title is None:
+            self._page_title = self.old_path.stem.replace('"', r"\"")
+        return self._page_title
 
     @property
-    def is_md(self) -> bool:
-        return self.is_file and self.old_path.suffix == ".md"
+    def document(self) -> "Document":
+        """file contents, read on first access and shared by all accessors"""
+        if self._document is None:
+            self._document = Document(self.old_path)
+        return self._document
 
     @property
     def modified(self) -> str:
@@ -228,57 +746,69 @@ class DocPath:
                     val += '+00:00'
                 return val
         # fallback to fs mtime
-        dt = datetime.fromtimestamp(os.path.getmtime(self.old_path))
+        dt = datetime.fromtimestamp(self.document.mtime)
         return dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
 
     @property
     def content(self) -> List[str]:
         """gets lines of file but ignores frontmatter"""
-        with open(self.old_path, "r") as f:
-            lines = f.readlines()
-            if lines[0].startswith("---"):
-                for i, line in enumerate(lines[1:]):
-                    if line.startswith("---"):
-                        return lines[i + 2:]
-            return lines
+        if self.document.streamed:
+            return list(self.document.iter_lines())
+        return self.document.lines
 
     @property
     def frontmatter(self) -> Dict[str, str]:
         """gets frontmatter of file"""
-        with open(self.old_path, "r") as f:
-            lines = f.readlines()
-            if lines[0].startswith("---"):
-                for i, line in enumerate(lines[1:]):
-                    if line.startswith("---"):
-                        return yaml.load("".join(lines[1:i + 1]), Loader=yaml.FullLoader)
-            return {}
+        return self.document.frontmatter
 
     def write(self, content: Union[str, List[str]]):
         """writes content to new path"""
         if not isinstance(content, str):
             content = "".join(content)
-        self.new_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(self.new_path, "w") as f:
-            f.write(content)
+        write_text(self.new_path, content)
+
+    def write_stream(self, parts: Iterable[str]):
+        """writes content too large to join to new path"""
+        write_stream(self.new_path, parts)
 
     # --------------------------------- Resources -------------------------------- #
 
-    @property
-    def is_file(self) -> bool:
-        return self.old_path.is_file()
+    def copy(self) -> str:
+        """puts file from old path at new path, see place_file"""
+        return place_file(self.old_path, self.new_path, Settings.is_true("LINK_RESOURCES"))
+
+    def write_variants(self, digest: str) -> List[str]:
+        """puts the IMAGE_WIDTHS variants of an image next to new path, named like
+        DocLink.render's srcset, see encode_variants. returns their paths relative to
+        content_dir, none for other files"""
+        widths = image_widths(Settings.options["IMAGE_WIDTHS"])
+        if not widths or self.old_path.suffix.lower() not in RESPONSIVE_EXTENSIONS:
+            return []
+        # IMAGE_WIDTHS is only kept when Pillow is installed, see Settings.parse_env
+        from PIL import Image
 
-    def copy(self):
-        """copies file from old path to new path"""
-        self.new_path.parent.mkdir(parents=True, exist_ok=True)
-        shutil.copyfile(self.old_path, self.new_path)
+        try:
+            encoded = encode_variants(self.old_path, digest, widths)
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            log.warning("can't make variants of %s: %s", self.old_rel_path, e)
+            return []
+        base = str(self.new_rel_path.with_suffix(""))
+        variants = []
+        for width, cached in zip(widths, encoded):
+            rel_path = variant_name(base, width)
+            place_file(cached, content_dir / rel_path)
+            variants.append(rel_path)
+        return variants
 
     # ----------------------------------- Graph ---------------------------------- #
 
     @property
     def abs_url(self) -> str:
         """returns absolute URL to the page"""
-        assert self.is_md
-        return quote(f"/{str(self.new_rel_path)[:-3]}")
+        if self._abs_url is None:
+            assert self.is_md
+            self._abs_url = quote(f"/{str(self.new_rel_path)[:-3]}")
+        return self._abs_url
 
     def edge(self, other: str) -> Tuple[str, str]:
         """gets edge from page's URL to another URL"""
@@ -289,6 +819,20 @@ class DocPath:
 #                                   Settings                                   #
 # ---------------------------------------------------------------------------- #
 
+# ___KEY___ in theme files, replaced with the option KEY
+PLACEHOLDER_PATTERN = re.compile(r"___([A-Z0-9]+(?:_[A-Z0-9]+)*)___")
+# theme files under site_dir that may hold placeholders. not all of static, as convert.py
+# writes page titles there
+THEME_FILES = (
+    "config.toml",
+    "content/_index.md",
+    "templates/**/*.html",
+    "sass/**/*.scss",
+    "static/**/*.css",
+    "static/js/graph.js",
+)
+
+
 class Settings:
     options: Dict[str, Optional[str]] = {
         "SITE_URL": None,
@@ -306,6 +850,16 @@ class Settings:
         "PAGE_GRAPH": "y",
         "SUBSECTION_SYMBOL": "<div class='folder'><svg xmlns='http://www.w3.org/2000/svg' viewBox='0 0 512 512'><path d='M448 96h-172.1L226.7 50.75C214.7 38.74 198.5 32 181.5 32H64C28.65 32 0 60.66 0 96v320c0 35.34 28.65 64 64 64h384c35.35 0 64-28.66 64-64V160C512 124.7 483.3 96 448 96zM64 80h117.5c4.273 0 8.293 1.664 11.31 4.688L256 144h192c8.822 0 16 7.176 16 16v32h-416V96C48 87.18 55.18 80 64 80zM448 432H64c-8.822 0-16-7.176-16-16V240h416V416C464 424.8 456.8 432 448 432z' /></svg></div>",
         "LOCAL_GRAPH": "",
+        "GRAPH_SHARDS": "",
+        "GRAPH_STATS": "",
+        "GRAPH_LAYOUT": "",
+        "PRERENDER_LIMIT": "5",
+        "SEARCH_INDEX": "",
+        "SEARCH_STOP_WORDS": "",
+        "LINK_RESOURCES": "y",
+        "IGNORE_PATTERNS": ".git/, .obsidian/, .trash/",
+        "IMAGE_WIDTHS": "",
+        "IMAGE_FORMAT": "webp",
         "GRAPH_LINK_REPLACE": "",
         "STRICT_LINE_BREAKS": "",
         "SIDEBAR_COLLAPSED": "",
@@ -373,19 +927,186 @@ class Settings:
                     raise Exception(f"FATAL ERROR: build.environment.{key} not set!")
         if cls.options["SITE_TITLE_TAB"] == "":
             cls.options["SITE_TITLE_TAB"] = cls.options["SITE_TITLE"]
-        print("Options:")
-        pp(cls.options)
+        if cls.options["IMAGE_WIDTHS"]:
+            try:
+                from PIL import Image
+
+                Image.registered_extensions()[f".{cls.options['IMAGE_FORMAT']}"]
+            except (ImportError, KeyError):
+                log.warning(
+                    "IMAGE_WIDTHS needs Pillow with %s support, images are copied as they are",
+                    cls.options["IMAGE_FORMAT"],
+                )
+                cls.options["IMAGE_WIDTHS"] = ""
+        log.debug("options: %s", cls.options)
+
+    @classmethod
+    def sub_text(cls, text: str, unknown: Optional[set] = None) -> str:
+        """fills in every ___KEY___ placeholder in one scan. placeholders that aren't
+        options are kept and added to unknown"""
+        def replace(match: re.Match) -> str:
+            key = match.group(1)
+            if key in cls.options:
+                return cls.options[key] or ""
+            if unknown is not None:
+                unknown.add(match.group(0))
+            return match.group(0)
+
+        return PLACEHOLDER_PATTERN.sub(replace, text)
+
+    @classmethod
+    def sub_file(cls, path: Path) -> bool:
+        """fills in the placeholders of a file, only rewriting it when it has some.
+        warns about unknown ones, returns whether it wrote"""
+        text = path.read_text(encoding="utf-8")
+        if "___" not in text:
+            return False
+        unknown: set = set()
+        content = cls.sub_text(text, unknown)
+        if unknown:
+            log.warning("unknown placeholders in %s: %s", path.relative_to(site_dir), ", ".join(sorted(unknown)))
+        return write_text(path, content)
 
     @classmethod
-    def sub_line(cls, line: str) -> str:
-        for key, val in cls.options.items():
-            line = line.replace(f"___{key}___", val if val else "")
-        return line
+    def sub_theme(cls):
+        """sub_file over every file matching THEME_FILES"""
+        for pattern in THEME_FILES:
+            for path in sorted(site_dir.glob(pattern)):
+                cls.sub_file(path)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Manifest                                   #
+# ---------------------------------------------------------------------------- #
+
+def file_digest(path: Path) -> str:
+    """sha1 of a file, read in chunks so large resources are never loaded whole"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """per-path results of the previous build, lets unchanged paths skip conversion"""
+    path = site_dir / ".convert-manifest.json"
+
+    def __init__(self, version: Optional[str] = None, paths: Optional[Dict[str, dict]] = None):
+        self.version = version
+        self.paths = paths or {}
 
     @classmethod
-    def sub_file(cls, path: Path):
-        content = "".join([cls.sub_line(line) for line in open(path, "r").readlines()])
-        open(path, "w").write(content)
+    def load(cls) -> "Manifest":
+        try:
+            with open(cls.path, "r") as f:
+                data = json.load(f)
+            return cls(data["version"], data["paths"])
+        except (OSError, ValueError, KeyError):
+            return cls()
+
+    def save(self):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "paths": self.paths}, f)
+        tmp_path.replace(self.path)
+
+
+# ---------------------------------------------------------------------------- #
+#                                   Profiling                                  #
+# ---------------------------------------------------------------------------- #
+
+class Profiler:
+    """wall time and call count per stage, the slowest pages and a chrome trace.
+    on with PROFILE_BUILD, read from the environment so it doesn't touch the manifest
+    version. when off, stage() hands out one shared no-op context manager"""
+    enabled = environ.get("PROFILE_BUILD", "").lower() in ('true', '1', 'yes', 'y', 'on')
+    slowest_count = 20
+    stages: Dict[str, List[float]] = {}
+    pages: List[Tuple[float, str]] = []
+    events: List[Dict[str, Any]] = []
+    _noop = nullcontext()
+
+    @classmethod
+    def stage(cls, name: str, page: Optional[str] = None):
+        """times a block as stage `name`, blocks given a page also rank the slowest pages"""
+        if not cls.enabled:
+            return cls._noop
+        return cls._timed(name, page)
+
+    @classmethod
+    @contextmanager
+    def _timed(cls, name: str, page: Optional[str]) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            cls.record(name, elapsed)
+            cls.events.append({
+                "name": name, "ph": "X", "pid": os.getpid(), "tid": 0,
+                "ts": round(start * 1e6), "dur": round(elapsed * 1e6),
+                **({"args": {"page": page}} if page is not None else {}),
+            })
+            if page is not None:
+                cls.add_page(elapsed, page)
+
+    @classmethod
+    def record(cls, name: str, elapsed: float, calls: int = 1):
+        entry = cls.stages.setdefault(name, [0, 0.0])
+        entry[0] += calls
+        entry[1] += elapsed
+
+    @classmethod
+    def add_page(cls, elapsed: float, page: str):
+        if len(cls.pages) < cls.slowest_count:
+            heapq.heappush(cls.pages, (elapsed, page))
+        else:
+            heapq.heappushpop(cls.pages, (elapsed, page))
+
+    @classmethod
+    def drain(cls) -> Optional[Dict[str, Any]]:
+        """takes what this process recorded, for pool workers to send back"""
+        if not cls.enabled:
+            return None
+        data = {"stages": cls.stages, "pages": cls.pages, "events": cls.events}
+        cls.stages, cls.pages, cls.events = {}, [], []
+        return data
+
+    @classmethod
+    def merge(cls, data: Optional[Dict[str, Any]]):
+        if not data:
+            return
+        for name, (calls, elapsed) in data["stages"].items():
+            cls.record(name, elapsed, calls)
+        for elapsed, page in data["pages"]:
+            cls.add_page(elapsed, page)
+        cls.events.extend(data["events"])
+
+    @classmethod
+    def report(cls, directory: Path):
+        """writes profile.json and profile.trace.json (chrome://tracing, perfetto)"""
+        if not cls.enabled:
+            return
+        stages = {
+            name: {"calls": int(calls), "seconds": round(elapsed, 6)}
+            for name, (calls, elapsed) in sorted(cls.stages.items(), key=lambda item: -item[1][1])
+        }
+        slowest = [
+            {"page": page, "seconds": round(elapsed, 6)}
+            for elapsed, page in sorted(cls.pages, reverse=True)
+        ]
+        with open(directory / "profile.json", "w") as f:
+            json.dump({"stages": stages, "slowest_pages": slowest}, f, indent=2)
+        with open(directory / "profile.trace.json", "w") as f:
+            json.dump({"traceEvents": cls.events}, f)
+
+        log.info("profile:")
+        for name, stage in stages.items():
+            log.info("  %-16s %8d calls %10.3fs", name, stage["calls"], stage["seconds"])
+        for page in slowest[:5]:
+            log.info("  slow page %.3fs %s", page["seconds"], page["page"])
+        log.info("  written to %s", directory / "profile.json")
 
 
 # ---------------------------------------------------------------------------- #
@@ -397,61 +1118,466 @@ LAINCHAN_COLORS = [
     "#7a8a94", "#18635d", "#e8f5f0", "#a0a0a0",
 ]
 
-def parse_graph(nodes: Dict[str, str], edges: List[Tuple[str, str]]):
-    node_ids = {k: i for i, k in enumerate(nodes.keys())}
-    existing_edges = [
-        edge for edge in set(edges) if edge[0] in node_ids and edge[1] in node_ids
-    ]
-    edge_counts = {k: 0 for k in nodes.keys()}
-    for i, j in existing_edges:
-        edge_counts[i] += 1
-        edge_counts[j] += 1
+# node styles, nodes differ only by border color
+GRAPH_STYLES = [
+    {
+        "color": {
+            "background": "rgba(19, 26, 26, 0.3)",
+            "border": color,
+            "highlight": {
+                "background": "rgba(24, 99, 93, 0.4)",
+                "color": "#0b0f12"
+            }
+        },
+        "font": {
+            "color": "#ffffff",
+            "highlight": {"color": "#0b0f12"}
+        },
+    }
+    for color in LAINCHAN_COLORS
+]
+
+# build time layout (GRAPH_LAYOUT): pixels per ideal edge length, pull towards the centre
+LAYOUT_SCALE = 150
+LAYOUT_GRAVITY = 0.02
+# the layout cools by LAYOUT_COOLING per iteration and stops once nodes move less than
+# LAYOUT_TOLERANCE edge lengths on average, or after LAYOUT_MAX_ITERATIONS
+LAYOUT_COOLING = 0.95
+LAYOUT_TOLERANCE = 0.005
+LAYOUT_MAX_ITERATIONS = 1000
+# from the previous build's positions only nodes this many hops from a changed edge move,
+# starting at this temperature (edge lengths)
+LAYOUT_WARM_HOPS = 1
+LAYOUT_WARM_TEMPERATURE = 1.0
+# cells (edge lengths) repulsion reaches
+LAYOUT_REACH = 2
+# positions of the last layout, under site_dir
+LAYOUT_FILE = ".graph-layout.json"
+
+class GraphBuilder:
+    """accumulates the knowledge graph while pages are merged. urls are interned to ids
+    as they come in and every edge is kept once, as a pair in a flat id array"""
+
+    def __init__(self):
+        self.url_ids: Dict[str, int] = {}
+        self.urls: List[str] = []
+        self.titles: Dict[int, str] = {}
+        self.edge_keys = set()
+        self.edge_ids = array("L")
+
+    def intern(self, url: str) -> int:
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+        return url_id
+
+    def add_node(self, url: str, title: str):
+        """later titles replace earlier ones but nodes keep their first position"""
+        self.titles[self.intern(url)] = title
+
+    def add_edge(self, edge: Tuple[str, str]):
+        i, j = self.intern(edge[0]), self.intern(edge[1])
+        key = (i << 32 | j) if i < j else (j << 32 | i)
+        if key not in self.edge_keys:
+            self.edge_keys.add(key)
+            self.edge_ids.extend((i, j))
+
+    def build(self) -> "Graph":
+        """renumbers nodes densely in insertion order and drops edges to non-nodes,
+        counting degrees in the same pass"""
+        node_ids = array("l", [-1]) * len(self.urls)
+        for node_id, url_id in enumerate(self.titles):
+            node_ids[url_id] = node_id
+        edges = array("L")
+        degrees = array("L", [0]) * len(self.titles)
+        for k in range(0, len(self.edge_ids), 2):
+            i, j = node_ids[self.edge_ids[k]], node_ids[self.edge_ids[k + 1]]
+            if i >= 0 and j >= 0:
+                edges.extend((i, j))
+                degrees[i] += 1
+                degrees[j] += 1
+        return Graph(
+            [self.urls[url_id] for url_id in self.titles],
+            list(self.titles.values()),
+            edges,
+            degrees,
+        )
 
+class Graph:
+    """knowledge graph with node ids 0..n-1, edges as a flat array of id pairs"""
+
+    def __init__(self, urls: List[str], titles: List[str], edges: array, degrees: array):
+        self.urls = urls
+        self.titles = titles
+        self.edges = edges
+        self.degrees = degrees
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def pairs(self):
+        return zip(self.edges[::2], self.edges[1::2])
+
+    def value(self, node_id: int) -> float:
+        return math.log10(self.degrees[node_id] + 1) + 1
+
+    def adjacency(self) -> List[List[int]]:
+        neighbours: List[set] = [set() for _ in self.urls]
+        for i, j in self.pairs():
+            neighbours[i].add(j)
+            neighbours[j].add(i)
+        return [sorted(ids) for ids in neighbours]
+
+    def index(self) -> Dict[str, int]:
+        """decoded lowercase url -> id, the key graph.js looks pages up by"""
+        return {decode_uri(url).lower(): i for i, url in enumerate(self.urls)}
+
+    def components(self) -> List[int]:
+        """sizes of connected components, largest first (union find)"""
+        parents = array("L", range(len(self.urls)))
+
+        def find(i: int) -> int:
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, j in self.pairs():
+            i, j = find(i), find(j)
+            if i != j:
+                parents[max(i, j)] = min(i, j)
+        sizes: Dict[int, int] = {}
+        for i in range(len(self.urls)):
+            root = find(i)
+            sizes[root] = sizes.get(root, 0) + 1
+        return sorted(sizes.values(), reverse=True)
+
+    def hubs(self, count: int = 10) -> List[Tuple[str, int]]:
+        """most linked nodes as (url, degree)"""
+        top = heapq.nlargest(count, range(len(self.urls)), key=self.degrees.__getitem__)
+        return [(self.urls[i], self.degrees[i]) for i in top]
+
+def layout_graph(
+    graph: Graph, adjacency: List[List[int]], previous: Dict[str, List[int]], touched: Iterable[str] = ()
+) -> List[Tuple[int, int]]:
+    """force directed pixel positions of the nodes: fruchterman-reingold repulsion, linear
+    attraction along edges, run until it settles. nodes are binned into cells one edge
+    length wide, cell mates repel exactly and cells up to LAYOUT_REACH away as one mass at
+    their centroid, so an iteration is linear in the nodes. when most nodes are in previous
+    they stay where they were and only new nodes and those LAYOUT_WARM_HOPS from a touched
+    url (an end of a changed edge) move. new nodes start next to their placed neighbours"""
+    n = len(graph)
+    rng = random.Random(0)
+    around = range(-LAYOUT_REACH, LAYOUT_REACH + 1)
+    reach2 = LAYOUT_REACH * LAYOUT_REACH
+    spread = math.sqrt(n) + 1
+    xs = [0.0] * n
+    ys = [0.0] * n
+    placed = [url in previous for url in graph.urls]
+    for i, url in enumerate(graph.urls):
+        if placed[i]:
+            xs[i], ys[i] = previous[url][0] / LAYOUT_SCALE, previous[url][1] / LAYOUT_SCALE
+    warm = sum(placed) * 2 > n
+    if warm:
+        url_ids = {url: i for i, url in enumerate(graph.urls)}
+        free = [not placed[i] for i in range(n)]
+        level = [url_ids[url] for url in touched if url in url_ids]
+        for _ in range(LAYOUT_WARM_HOPS + 1):
+            for i in level:
+                free[i] = True
+            level = [j for i in level for j in adjacency[i] if not free[j]]
+    else:
+        free = [True] * n
+    for i in range(n):
+        if placed[i]:
+            continue
+        near = [j for j in adjacency[i] if placed[j]]
+        if near:
+            xs[i] = sum(xs[j] for j in near) / len(near) + rng.uniform(-0.5, 0.5)
+            ys[i] = sum(ys[j] for j in near) / len(near) + rng.uniform(-0.5, 0.5)
+        else:
+            xs[i] = rng.uniform(-spread, spread) / 2
+            ys[i] = rng.uniform(-spread, spread) / 2
+        placed[i] = True
+
+    moving = [i for i in range(n) if free[i]]
+    pairs = [(i, j) for i, j in graph.pairs() if i != j and (free[i] or free[j])]
+    temperature = LAYOUT_WARM_TEMPERATURE if warm else spread / 4
+    for _ in range(LAYOUT_MAX_ITERATIONS if moving else 0):
+        fx = [0.0] * n
+        fy = [0.0] * n
+        cells: Dict[Tuple[int, int], List[int]] = {}
+        for i in range(n):
+            cells.setdefault((math.floor(xs[i]), math.floor(ys[i])), []).append(i)
+        centroids = {
+            key: (sum(xs[i] for i in members) / len(members), sum(ys[i] for i in members) / len(members), len(members))
+            for key, members in cells.items()
+        }
+        for (cx, cy), members in cells.items():
+            if not any(free[i] for i in members):
+                continue
+            # cells around are one mass at their centroid, cell mates repel exactly
+            masses = [
+                centroids[key] for key in ((cx + dx, cy + dy) for dx in around for dy in around)
+                if key in centroids and key != (cx, cy)
+            ]
+            masses.extend((xs[j], ys[j], 1) for j in members)
+            for i in members:
+                if not free[i]:
+                    continue
+                xi, yi = xs[i], ys[i]
+                rx = ry = 0.0
+                for xj, yj, mass in masses:
+                    dx, dy = xi - xj, yi - yj
+                    d2 = dx * dx + dy * dy
+                    # k^2 / d along the unit vector with k = 1, not from the node itself
+                    if 0 < d2 < reach2:
+                        rx += mass * dx / d2
+                        ry += mass * dy / d2
+                fx[i] += rx
+                fy[i] += ry
+        for i, j in pairs:
+            dx, dy = xs[i] - xs[j], ys[i] - ys[j]
+            # linear in d along the unit vector
+            fx[i] -= dx
+            fy[i] -= dy
+            fx[j] += dx
+            fy[j] += dy
+        moved = 0.0
+        for i in moving:
+            x = fx[i] - LAYOUT_GRAVITY * xs[i]
+            y = fy[i] - LAYOUT_GRAVITY * ys[i]
+            length = math.sqrt(x * x + y * y)
+            if length > temperature:
+                x, y = x * temperature / length, y * temperature / length
+                length = temperature
+            xs[i] += x
+            ys[i] += y
+            moved += length
+        temperature *= LAYOUT_COOLING
+        if moved < LAYOUT_TOLERANCE * len(moving):
+            break
+    return [(round(x * LAYOUT_SCALE), round(y * LAYOUT_SCALE)) for x, y in zip(xs, ys)]
+
+def load_layout(graph: Graph, adjacency: List[List[int]]) -> List[Tuple[int, int]]:
+    """layout_graph warm started from the last build's LAYOUT_FILE, whose positions are
+    kept as they are when the graph didn't change. its edges tell which ones did"""
+    path = site_dir / LAYOUT_FILE
+    edges = sorted({tuple(sorted((graph.urls[i], graph.urls[j]))) for i, j in graph.pairs()})
+    digest = hashlib.sha1(json.dumps([graph.urls, edges]).encode()).hexdigest()
+    try:
+        with open(path) as f:
+            previous = json.load(f)
+        positions, old_edges = previous["positions"], previous["edges"]
+    except (FileNotFoundError, ValueError, KeyError):
+        previous = {"graph": None}
+        positions, old_edges = {}, []
+    if previous["graph"] == digest:
+        return [tuple(positions[url]) for url in graph.urls]
+
+    changed = set(edges).symmetric_difference(map(tuple, old_edges))
+    layout = layout_graph(graph, adjacency, positions, {url for edge in changed for url in edge})
+    write_text(path, json.dumps({"graph": digest, "positions": dict(zip(graph.urls, layout)), "edges": edges}))
+    return layout
+
+def site_root() -> str:
+    """SITE_URL from its first slash on (protocol relative for full urls), prepended to urls javascript builds"""
     base_url = Settings.options['SITE_URL']
     non_root_start = base_url.find('/')
-    non_root_part = base_url[non_root_start:] if non_root_start != -1 else ''
-    
-    graph_info = {
-        "nodes": [
-            {
-                "id": node_ids[url],
-                "label": title,
-                "url": url,
-                "root_url": non_root_part + url,
-                "color": {
-                    "background": "rgba(19, 26, 26, 0.3)",
-                    "border": LAINCHAN_COLORS[idx % len(LAINCHAN_COLORS)],
-                    "highlight": {
-                        "background": "rgba(24, 99, 93, 0.4)",
-                        "color": "#0b0f12"
-                    }
-                },
-                "font": {
-                    "color": "#ffffff",
-                    "highlight": {"color": "#0b0f12"}
-                },
-                "value": math.log10(edge_counts[url] + 1) + 1,
-            }
-            for idx, (url, title) in enumerate(nodes.items())
-        ],
-        "edges": [
-            {"from": node_ids[edge[0]], "to": node_ids[edge[1]]}
-            for edge in set(edges)
-            if edge[0] in node_ids and edge[1] in node_ids
-        ],
-    }
-    graph_info = json.dumps(graph_info)
+    return base_url[non_root_start:] if non_root_start != -1 else ''
+
+def parse_graph(graph: Graph):
+    if Settings.is_true("GRAPH_STATS"):
+        components = graph.components()
+        log.info(
+            "graph: %d nodes, %d edges, %d components (largest %d)",
+            len(graph), len(graph.edges) // 2, len(components), components[0] if components else 0,
+        )
+        for url, degree in graph.hubs():
+            log.info("  hub %5d %s", degree, url)
+
+    index = graph.index()
+    adjacency = graph.adjacency()
+    non_root_part = site_root()
+    layout = load_layout(graph, adjacency) if Settings.is_true("GRAPH_LAYOUT") else None
+
+    graph_styles = "null"
+    if Settings.is_true("GRAPH_SHARDS"):
+        write_graph_shards(graph, index, adjacency, layout)
+        graph_info = "null"
+        graph_styles = json.dumps(GRAPH_STYLES)
+    else:
+        remove_shards(site_dir / "static/graph.json", site_dir / "static/graph")
+        graph_info = {
+            "nodes": [
+                {
+                    "id": i,
+                    "label": title,
+                    "url": url,
+                    "root_url": non_root_part + url,
+                    **GRAPH_STYLES[i % len(GRAPH_STYLES)],
+                    "value": graph.value(i),
+                    **({"x": layout[i][0], "y": layout[i][1]} if layout else {}),
+                }
+                for i, (url, title) in enumerate(zip(graph.urls, graph.titles))
+            ],
+            "edges": [{"from": i, "to": j} for i, j in graph.pairs()],
+            "index": index,
+            "adjacency": adjacency,
+        }
+        graph_info = json.dumps(graph_info)
+
+    is_local = "true" if Settings.is_true("LOCAL_GRAPH") else "false"
+    link_replace = "true" if Settings.is_true("GRAPH_LINK_REPLACE") else "false"
+    has_layout = "true" if layout else "false"
+    write_text(site_dir / "static/js/graph_info.js", "\n".join([
+        f"var graph_data={graph_info}",
+        f"var graph_is_local={is_local}",
+        f"var graph_layout={has_layout}",
+        f"var graph_link_replace={link_replace}",
+        f"var graph_root={json.dumps(non_root_part)}",
+        f"var graph_styles={graph_styles}",
+    ]))
+
+def decode_uri(url: str) -> str:
+    """unquotes like javascript's decodeURI, which leaves reserved characters escaped"""
+    return unquote(re.sub(r"%(2[346BCF]|3[ABDF]|40)", r"%25\1", url, flags=re.IGNORECASE))
+
+def remove_shards(*paths: Path):
+    """deletes the shard files and directories of a feature turned off since the last build"""
+    for path in paths:
+        if path.is_dir():
+            shutil.rmtree(path)
+            log.debug("removed stale shards: %s", path.relative_to(site_dir))
+        elif path.exists():
+            path.unlink()
+            log.debug("removed stale shards: %s", path.relative_to(site_dir))
+
+def write_graph_shards(
+    graph: Graph, index: Dict[str, int], adjacency: List[List[int]],
+    layout: Optional[List[Tuple[int, int]]] = None,
+):
+    """writes static/graph.json with the whole graph and static/graph/<url>.json with each
+    page's neighbourhood. nodes are [id, label, url, style, value] with style an index
+    into GRAPH_STYLES (graph_styles in graph_info.js), plus x and y given a layout. edges
+    are a flat list of id pairs. graph.json also carries the url index, graph.js indexes
+    the small neighbourhoods itself"""
+    compact_nodes = [
+        [i, title, url, i % len(GRAPH_STYLES), round(graph.value(i), 3), *(layout[i] if layout else ())]
+        for i, (url, title) in enumerate(zip(graph.urls, graph.titles))
+    ]
 
-    with open(site_dir / "static/js/graph_info.js", "w") as f:
-        is_local = "true" if Settings.is_true("LOCAL_GRAPH") else "false"
-        link_replace = "true" if Settings.is_true("GRAPH_LINK_REPLACE") else "false"
-        f.write("\n".join([
-            f"var graph_data={graph_info}",
-            f"var graph_is_local={is_local}",
-            f"var graph_link_replace={link_replace}",
-        ]))
+    def write_shard(path: Path, ids: List[int], **extra):
+        members = set(ids)
+        write_text(path, json.dumps({
+            "nodes": [compact_nodes[i] for i in ids],
+            "edges": [x for i in ids for j in adjacency[i] if i <= j and j in members for x in (i, j)],
+            **extra,
+        }, separators=(",", ":")))
+
+    write_shard(site_dir / "static/graph.json", list(range(len(compact_nodes))), index=index)
+
+    # shards of removed pages are deleted, the others only rewritten when they change
+    graph_dir = site_dir / "static/graph"
+    shard_paths = set()
+    for i, node in enumerate(compact_nodes):
+        path = graph_dir / f"{unquote(node[2]).lstrip('/')}.json"
+        shard_paths.add(path)
+        write_shard(path, sorted({i, *adjacency[i]}))
+    for path in graph_dir.rglob("*.json"):
+        if path not in shard_paths:
+            path.unlink()
 
 def write_settings():
-    with open(site_dir / "static/js/settings.js", "w") as f:
-        sidebar_collapsed = "true" if Settings.is_true("SIDEBAR_COLLAPSED") else "false"
-        f.write(f"var sidebar_collapsed={sidebar_collapsed}")
\ No newline at end of file
+    sidebar_collapsed = "true" if Settings.is_true("SIDEBAR_COLLAPSED") else "false"
+    write_text(site_dir / "static/js/settings.js", f"var sidebar_collapsed={sidebar_collapsed}")
+
+
+# ---------------------------------------------------------------------------- #
+#                                 Search Index                                 #
+# ---------------------------------------------------------------------------- #
+
+SEARCH_PREFIX = 2
+SEARCH_DOCS_PER_SHARD = 500
+SEARCH_SUMMARY_WORDS = 40
+SEARCH_WEIGHTS = {"title": 5, "tags": 3, "body": 1}
+
+# same as /[\p{L}\p{N}_]+/gu in search.js
+SEARCH_WORD = re.compile(r"\w+")
+MARKUP = re.compile(r"<[^>\n]*>|!?\[([^\]\n]*)\]\([^)\n]*\)|[#*_`>|~\[\]]+")
+STOP_WORDS = frozenset("""
+    a about after all also an and any are as at be because been but by can could did do does
+    for from had has have he her his how i if in into is it its just me more most my no not
+    of on or our out over she so some such than that the their them then there these they
+    this those to too up us was we were what when where which who why will with would you your
+""".split())
+
+
+def plain_text(markdown: str) -> str:
+    """markdown without tags, link targets and emphasis"""
+    return MARKUP.sub(lambda match: match.group(1) or " ", markdown)
+
+
+def search_terms(text: str) -> List[str]:
+    """lowercase words of text, minus STOP_WORDS if SEARCH_STOP_WORDS is set"""
+    words = SEARCH_WORD.findall(text.lower())
+    if Settings.is_true("SEARCH_STOP_WORDS"):
+        return [word for word in words if word not in STOP_WORDS]
+    return words
+
+
+def index_page(title: str, tags: Any, markdown: Iterable[str]) -> Tuple[Dict[str, int], str]:
+    """weighted term counts of a page and the summary search results show. markdown
+    comes in chunks of whole lines"""
+    if not isinstance(tags, list):
+        tags = [tags]
+    terms: Counter = Counter()
+    for field, value in (("title", title), ("tags", " ".join(map(str, tags)))):
+        for term in search_terms(value):
+            terms[term] += SEARCH_WEIGHTS[field]
+    summary: List[str] = []
+    for chunk in markdown:
+        text = plain_text(chunk)
+        for term in search_terms(text):
+            terms[term] += SEARCH_WEIGHTS["body"]
+        if len(summary) < SEARCH_SUMMARY_WORDS:
+            summary += text.split()[:SEARCH_SUMMARY_WORDS - len(summary)]
+    return dict(terms), " ".join(summary)
+
+
+def write_search_index(pages: List[Tuple[str, str, str, Dict[str, int]]]):
+    """writes the search index for (url, title, summary, terms) of every page to static/search:
+    meta.json with the counts search.js needs, docs/<n>.json with [url, title, summary] of
+    SEARCH_DOCS_PER_SHARD pages each (doc ids count up across them) and one <prefix>.json per
+    SEARCH_PREFIX long term prefix (utf-8 hex) mapping its terms to flat doc id, weight pairs.
+    shorter terms are their own prefix"""
+    pages = sorted(pages)
+    shards: Dict[str, Dict[str, List[int]]] = {}
+    for doc, (_, _, _, terms) in enumerate(pages):
+        for term, weight in terms.items():
+            shards.setdefault(term[:SEARCH_PREFIX], {}).setdefault(term, []).extend((doc, weight))
+
+    search_dir = site_dir / "static/search"
+    shard_paths = set()
+
+    def write_shard(path: Path, data: Any):
+        shard_paths.add(path)
+        write_text(path, json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+    write_shard(search_dir / "meta.json", {
+        "docs": len(pages),
+        "prefix": SEARCH_PREFIX,
+        "per_shard": SEARCH_DOCS_PER_SHARD,
+        "root": site_root(),
+    })
+    for start in range(0, len(pages), SEARCH_DOCS_PER_SHARD):
+        chunk = pages[start:start + SEARCH_DOCS_PER_SHARD]
+        write_shard(search_dir / f"docs/{start // SEARCH_DOCS_PER_SHARD}.json", [page[:3] for page in chunk])
+    for prefix, terms in shards.items():
+        write_shard(search_dir / f"{prefix.encode().hex()}.json", dict(sorted(terms.items())))
+
+    # shards no page needs anymore are deleted, the others only rewritten when they change
+    for path in search_dir.rglob("*.json"):
+        if path not in shard_paths:
+            path.unlink()
@@ -0,0 +1,141 @@
+"""
+Watches a directory tree for changed paths: inotify on linux, polling elsewhere.
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name
+EVENT = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    """inotify through libc, one watch per directory"""
+
+    def __init__(self, root: Path):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs: Dict[int, Path] = {}
+        self.add_tree(root)
+
+    def add_tree(self, root: Path):
+        for directory, _, _ in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = Path(directory)
+
+    def read(self, timeout: Optional[float]) -> Set[Path]:
+        """paths changed within timeout seconds (forever if None), empty if none"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 1 << 16)
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, everything may have changed
+                changed.add(self.root)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = directory / os.fsdecode(name) if name else directory
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            changed.add(path)
+        return changed
+
+
+class PollingWatcher:
+    """compares size and mtime of every file each interval"""
+
+    def __init__(self, root: Path, interval: float = 0.5):
+        self.root = root
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self) -> Dict[Path, Tuple[int, int]]:
+        files = {}
+        stack = [self.root]
+        while stack:
+            try:
+                entries = list(os.scandir(stack.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(Path(entry.path))
+                else:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    files[Path(entry.path)] = (stat.st_mtime_ns, stat.st_size)
+        return files
+
+    def read(self, timeout: Optional[float]) -> Set[Path]:
+        """paths changed within timeout seconds (forever if None), empty if none"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            time.sleep(max(0.0, wait))
+            files = self.scan()
+            changed = {
+                path for path in files.keys() | self.files.keys()
+                if files.get(path) != self.files.get(path)
+            }
+            self.files = files
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+
+def open_watcher(root: Path, poll: Optional[float] = None):
+    """inotify where available unless a poll interval is given"""
+    if poll is None and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, poll or 0.5)
+
+
+def watch(root: Path, debounce: float = 0.1, poll: Optional[float] = None) -> Iterator[Set[Path]]:
+    """yields sets of changed paths under root, each once nothing else changed for
+    debounce seconds, so a burst of saves or an export becomes one batch"""
+    watcher = open_watcher(root, poll)
+    while True:
+        changed = watcher.read(None)
+        while True:
+            more = watcher.read(debounce)
+            if not more:
+                break
+            changed |= more
+        yield changed